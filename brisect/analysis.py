@@ -7,9 +7,19 @@ Created on Fri Jan 20 10:29:35 2023
 A file containing functions which analyse output data acquired using the scan
 module.
 """
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
-from scipy.optimize import curve_fit
+import os
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import least_squares
+
+# Number of points processed at once when computing distances from a
+# rectangle. Large enough to amortise the per-block overhead, small enough that
+# the intermediate arrays fit in cache.
+_RECT_DIST_BLOCK = 4096
+# Number of threads used to compute distances from a rectangle for large scans.
+_RECT_DIST_THREADS = os.cpu_count() or 1
 
 def correct_liftoff(*args):
     """
@@ -82,10 +92,10 @@ def lin_liftoff_params(data):
     A, B, C : floats
         Coefficients of the linear equation z = Ax + By + C.
     """
-    threshold = (np.nanmax(data[:, 2]) - np.nanmin(data[:, 2])) / 1.5
-    data = data[data[:, 2] > np.nanmin(data[:, 2])+threshold, :]
-    A = np.vstack([data[:, 0], data[:, 1], np.ones(data.shape[0])]).T
-    return np.linalg.lstsq(A, data[:, 2], rcond=None)[0]
+    x, y, z = _liftoff_columns(data)
+    # The constant column is a zero-copy broadcast, written straight into A.
+    A = np.column_stack((x, y, np.broadcast_to(1., x.shape)))
+    return _lstsq_normal(A, z)
 
 def quad_liftoff_params(data):
     """
@@ -103,16 +113,68 @@ def quad_liftoff_params(data):
     A, B, C, D, E, F : floats
         Coefficients of the linear equation z = Ax^2 + Bxy + Cy^2 + Dx + Ey + F.
     """
-    threshold = (np.nanmax(data[:, 2]) - np.nanmin(data[:, 2])) / 1.5
-    data = data[data[:, 2] > np.nanmin(data[:, 2])+threshold, :]
-    A = np.vstack([data[:, 0]**2, data[:, 0]*data[:, 1], data[:, 1]**2, data[:, 0], data[:, 1], np.ones(data.shape[0])]).T
-    return np.linalg.lstsq(A, data[:, 2], rcond=None)[0]
+    x, y, z = _liftoff_columns(data)
+    # Fill the design matrix column by column, so the products are written
+    # straight into it rather than each being held as a temporary.
+    A = np.empty((x.shape[0], 6))
+    np.multiply(x, x, out=A[:, 0])
+    np.multiply(x, y, out=A[:, 1])
+    np.multiply(y, y, out=A[:, 2])
+    A[:, 3] = x
+    A[:, 4] = y
+    A[:, 5] = 1.
+    return _lstsq_normal(A, z)
+
+def _liftoff_columns(data):
+    """
+    Returns the x, y and z columns of data which are used to fit the liftoff,
+    each as a separate 1D array. Only the columns are masked, rather than
+    copying the (n, 3) array and then slicing it again.
+    """
+    mask = _liftoff_mask(data[:, 2])
+    return data[:, 0][mask], data[:, 1][mask], data[:, 2][mask]
+
+def _liftoff_mask(z):
+    """
+    Returns a mask of the values in z which are used to fit the liftoff, i.e.
+    those in the top third of the range of z. The min and max are only found
+    once, rather than once for the threshold and again for the comparison.
+    """
+    z_min, z_max = np.nanmin(z), np.nanmax(z)
+    return z > z_min + (z_max - z_min) / 1.5
+
+def _lstsq_normal(A, b):
+    """
+    Solves the least-squares problem Ax = b via the normal equations, i.e. by
+    Cholesky decomposition of A^T A. For the tall, narrow design matrices used
+    in the liftoff fits this is much cheaper than the SVD used by
+    np.linalg.lstsq. Falls back to np.linalg.lstsq if A^T A is singular.
+
+    Parameters
+    ----------
+    A : ndarray (n, k)
+        Design matrix, with n >> k.
+    b : ndarray (n,)
+        Measured values.
+
+    Returns
+    -------
+    x : ndarray (k,)
+        Least-squares solution.
+    """
+    try:
+        return cho_solve(cho_factor(np.dot(A.T, A)), np.dot(A.T, b))
+    except np.linalg.LinAlgError:
+        return np.linalg.lstsq(A, b, rcond=None)[0]
 
 def fit_geometry_to_data(coordinates, scan_data, geom_profile="rect", init_params="default"):
     """
     Attempts to work out the geometry of the sample measured in "data" by using
-    scipy's curve_fit function. Note that each geometry must have its own
-    distance minimisation function defined.
+    scipy's least_squares function to minimise the distance of the edge points
+    from the geometry. Note that each geometry must have its own distance
+    minimisation function defined, and may have an analytic Jacobian of it and
+    bounds on its parameters (e.g. the rectangle's width and height must be
+    positive).
     
     data is assumed to be an ndarray with shape (N, 3) containing N 
     measurements, where the 0th col contains the x-coords, the 1st col contains
@@ -121,7 +183,7 @@ def fit_geometry_to_data(coordinates, scan_data, geom_profile="rect", init_param
     
     init_params can be one of three forms:
         - None: 
-            do not use any initial parameters.
+            do not use any initial parameters (all are initialised to 1).
         - "default":
             use the default initial parameters specified in the geometry dict.
         - list of params:
@@ -137,29 +199,86 @@ def fit_geometry_to_data(coordinates, scan_data, geom_profile="rect", init_param
     # We expect the largest change in voltage to occur when the probe is moving
     # from off the sample to on the geometry. Differentiate the measurements
     # and filter based on that.
-    grad = np.abs(np.diff(scan_data[:]) / np.linalg.norm([np.diff(coordinates[0, :]), np.diff(coordinates[1, :])]))
+    grad = _spatial_gradient(coordinates, scan_data)
     #TODO: Need to choose a more appropriate threshold.
     grad_threshold = np.nanmax(grad)/2
-    coordinates = coordinates[:, :-1]
-    coordinates = coordinates[:, grad > grad_threshold]
+    # Only the in-plane coordinates are used from here on, so don't copy the
+    # other axes.
+    coordinates = coordinates[:2, :-1][:, grad > grad_threshold]
+    
+    # There is one residual per edge point, which must be at least the number
+    # of parameters for the fit to be determined. Check this before the
+    # default parameters are worked out from the edge points.
+    n_params = {"rect": 5, "line": 4}.get(geom_profile)
+    if n_params is not None and coordinates.shape[1] < n_params:
+        raise ValueError(f"fit_geometry_to_data: {coordinates.shape[1]} edge points found, but at least {n_params} are needed to fit a \"{geom_profile}\" profile.")
     
+    # Each profile contains [distance function, default initial parameters,
+    # Jacobian of the distance function, residual used while fitting,
+    # (lower, upper) bounds of the parameters]. Use finite differences where no
+    # analytic Jacobian is available.
     geom_profile_dict = {
-        "rect" : [lst_dist_from_rect, [np.nanmin(coordinates[0, :]), np.nanmin(coordinates[1, :]), np.nanmax(coordinates[0, :]) - np.nanmin(coordinates[0, :]), np.nanmax(coordinates[1, :]) - np.nanmin(coordinates[1, :]), 0]],
+        "rect" : [lst_dist_from_rect, [np.nanmin(coordinates[0, :]), np.nanmin(coordinates[1, :]), np.nanmax(coordinates[0, :]) - np.nanmin(coordinates[0, :]), np.nanmax(coordinates[1, :]) - np.nanmin(coordinates[1, :]), 0], _rect_dist_jac, _rect_residual, ([-np.inf, -np.inf, 1e-3, 1e-3, -np.pi], [np.inf, np.inf, np.inf, np.inf, np.pi])],
         "circ" : [],
-        "line" : [dist_from_line, [np.nanmin(coordinates[0, :]), np.nanmin(coordinates[1, :]), np.nanmax(coordinates[0, :]), np.nanmax(coordinates[1, :])]],
+        "line" : [dist_from_line, [np.nanmin(coordinates[0, :]), np.nanmin(coordinates[1, :]), np.nanmax(coordinates[0, :]), np.nanmax(coordinates[1, :])], "2-point", dist_from_line, (-np.inf, np.inf)],
     }
-    if init_params == "default":
-        init_params = geom_profile_dict[geom_profile][1] 
+    geom_fn, default_params, geom_jac, geom_residual, bounds = geom_profile_dict[geom_profile]
+    if init_params is None:
+        init_params = np.ones(len(default_params))
+    elif isinstance(init_params, str) and init_params == "default":
+        init_params = default_params
+    # Initial parameters must lie within the bounds.
+    init_params = np.clip(np.asarray(init_params, dtype=float), *bounds)
     
-    params, cov_mat = curve_fit(
-        geom_profile_dict[geom_profile][0],
-        coordinates[:2, :],
-        np.zeros(coordinates.shape[1]),
-        p0=init_params
+    # Validate the points once here rather than on every residual evaluation.
+    # These are kept in float64: the finite-difference Jacobians take steps of
+    # ~1e-8 relative to the parameters, which would be lost in float32.
+    pt = np.ascontiguousarray(coordinates, dtype=np.float64)
+    if geom_residual is dist_from_line:
+        scratch = np.empty(pt.shape)
+        geom_residual = lambda pt, *params: dist_from_line(pt, *params, scratch=scratch)
+    if callable(geom_jac):
+        jac = lambda params: geom_jac(pt, *params)
+    else:
+        jac = geom_jac
+    # Target distance of the edge points from the geometry is zero, so the
+    # residuals are the distances themselves.
+    result = least_squares(
+        lambda params: geom_residual(pt, *params),
+        init_params,
+        jac=jac,
+        bounds=bounds,
+        method="trf",
+        x_scale="jac"
     )
-    return {init_params:[geom_profile_dict[geom_profile][0], params]}
+    return {geom_profile:[geom_fn, result.x]}
+
+def _spatial_gradient(coordinates, scan_data):
+    """
+    Magnitude of the gradient of scan_data along the path of the probe, i.e.
+    |dV|/|dr| between each consecutive pair of measurements, where |dr| is the
+    in-plane distance moved between them. Pairs taken while the stage did not
+    move have no defined gradient and are returned as NaN.
+
+    Parameters
+    ----------
+    coordinates : ndarray (N, M)
+        Coordinates of the stage for each of the M measurements. Only the first
+        two axes are used.
+    scan_data : ndarray (M,)
+        Measured values.
 
-def dist_from_line(pt, start_x, start_y, end_x, end_y):
+    Returns
+    -------
+    grad : ndarray (M-1,)
+        Gradient between the mth and (m+1)th measurements.
+    """
+    step = np.hypot(np.diff(coordinates[0, :]), np.diff(coordinates[1, :]))
+    grad = np.full(step.shape, np.nan)
+    np.divide(np.abs(scan_data[1:] - scan_data[:-1]), step, out=grad, where=step > 0)
+    return grad
+
+def dist_from_line(pt, start_x, start_y, end_x, end_y, scratch=None):
     """
     Calculates the distance of m points with coordinates "pt" from the line
     segment which starts at coordinates "start" and ends at "end". Note that as
@@ -168,13 +287,16 @@ def dist_from_line(pt, start_x, start_y, end_x, end_y):
 
     Parameters
     ----------
-    pt : ndarray (n, m)
+    pt : ndarray (2, m)
         Coordinates of m points for which distance will be calculated.
-        n-dimensional numpy array.
-    start : ndarray (n,)
-        Coordinates of one point on the line. n-dimensional numpy array.
-    end : ndarray (n,)
-        Coordinates of a second point on the line. n-dimensional numpy array.
+    start_x, start_y : float
+        Coordinates of one point on the line.
+    end_x, end_y : float
+        Coordinates of a second point on the line.
+    scratch : ndarray (2, m), optional
+        Buffer which is overwritten with intermediate results. Passing the same
+        buffer to repeated calls (e.g. while fitting) avoids reallocating it
+        every time. Default is None, in which case one is allocated.
 
     Returns
     -------
@@ -182,26 +304,31 @@ def dist_from_line(pt, start_x, start_y, end_x, end_y):
         Distances of the points at coordinates "pt" from the line defined by
         points "start" and "end".
     """
-    pt, start, end = np.asarray(pt, dtype=float), np.asarray(start, dtype=float), np.asarray(end, dtype=float)
-    # Check same dimension, check there is one start coord, check that start and end have same shape.
-    if pt.shape[0] != start.shape[0] or start.shape != end.shape:
-        raise ValueError("dist_from_line: Number of dimensions in coordinates are not consistent.")
-    if len(start.shape) != 1:
-        raise ValueError("dist_from_line: Too many coordinates defined for line.")
+    pt, start, end = np.asarray(pt, dtype=float), np.asarray([start_x, start_y], dtype=float), np.asarray([end_x, end_y], dtype=float)
     if len(pt.shape) == 1:
         pt = pt.reshape((pt.shape[0], 1))
+    # Check same dimension.
+    if pt.shape[0] != start.shape[0]:
+        raise ValueError("dist_from_line: Number of dimensions in coordinates are not consistent.")
+    if scratch is None:
+        scratch = np.empty(pt.shape)
+    elif scratch.shape != pt.shape:
+        raise ValueError("dist_from_line: scratch must have the same shape as pt.")
     # Get vectors from origin.
     v1 = end - start
-    v2 = pt - start.reshape((-1, 1))
+    v2 = np.subtract(pt, start.reshape((-1, 1)), out=scratch)
     # Get dot-product of vectors scaled wrt segment (i.e. |v1| -> 1, |v2| -> |v2|/|v1|).
     # This is the location of the nearest point on the line in % of segment length.
-    nearest_perc = np.dot(v1/np.linalg.norm(v1), v2/np.linalg.norm(v1))
+    # A degenerate segment is a single point, nearest to everything.
+    length_sq = np.dot(v1, v1)
+    nearest_perc = np.dot(v1, v2) / length_sq if length_sq > 0 else np.zeros(pt.shape[1])
     # If nearest point is beyond the limits of the segment, set these to the limits so we find distance to segment.
-    nearest_perc[nearest_perc < 0.] = 0.
-    nearest_perc[nearest_perc > 1.] = 1.
-    # Work out the distance between each point and its nearest point on the line.
-    nearest = v1.reshape(-1, 1) * nearest_perc
-    return np.linalg.norm(v2 - nearest, axis=0)
+    np.clip(nearest_perc, 0., 1., out=nearest_perc)
+    # Work out the distance between each point and its nearest point on the
+    # line, reusing the buffers rather than allocating more.
+    v2 -= v1.reshape(-1, 1) * nearest_perc
+    dist = np.einsum('ij,ij->j', v2, v2, out=nearest_perc)
+    return np.sqrt(dist, out=dist)
 
 def lst_dist_from_rect(pt, origin_x, origin_y, width, height, rotation):
     """
@@ -232,22 +359,226 @@ def lst_dist_from_rect(pt, origin_x, origin_y, width, height, rotation):
         Distances of the points from the nearest edge in the rectangle.
     """
     pt, origin = np.asarray(pt, dtype=float), np.asarray([origin_x, origin_y], dtype=float)
-    height, width, rotation = float(height), float(width), float(rotation)
     if pt.shape[0] != 2 or origin.shape[0] != 2:
         raise ValueError("least_dist_from_rect: Coordinates must be 2D.")
     if len(origin.shape) != 1:
         raise ValueError("least_dist_from_rect: Too many coordinates defined for origin.")
-    # Initialise rotation matrix. Note that sign of sins is flipped as dims as origin is a row vector rather than a column vector.
-    rotation_matrix = np.asarray([[np.cos(rotation), np.sin(rotation)], [-np.sin(rotation), np.cos(rotation)]])
-    # Convert inputs to the four corners of the rectangle.
-    corner1 = origin
-    corner2 = origin + np.dot(np.asarray([width, 0]),      rotation_matrix)
-    corner3 = origin + np.dot(np.asarray([width, height]), rotation_matrix)
-    corner4 = origin + np.dot(np.asarray([0,     height]), rotation_matrix)
-    # Calculate the distance to each of the four segments.
-    dist1 = dist_from_line(pt, corner1[0], corner1[1], corner2[0], corner2[1])
-    dist2 = dist_from_line(pt, corner2[0], corner2[1], corner3[0], corner3[1])
-    dist3 = dist_from_line(pt, corner3[0], corner3[1], corner4[0], corner4[1])
-    dist4 = dist_from_line(pt, corner4[0], corner4[1], corner1[0], corner1[1])
-    # Get the smallest distance for each of the points.
-    return np.min([dist1, dist2, dist3, dist4], axis=0)
\ No newline at end of file
+    if len(pt.shape) == 1:
+        pt = pt.reshape((2, 1))
+    # Cast the parameters to float, so that they can be hashed by the cache
+    # and equal values share an entry whatever type they were given as.
+    return _rect_dist(pt, *_rect_edges(float(origin_x), float(origin_y), float(width), float(height), float(rotation)))
+
+@lru_cache(maxsize=16)
+def _rect_edges(origin_x, origin_y, width, height, rotation):
+    """
+    Corners and edge vectors of a rectangle, as used by `_rect_dist`. Cached on
+    the (float) parameters, as the fitting routines evaluate the same rectangle
+    repeatedly for the residual and its Jacobian. The returned arrays are
+    read-only as they are shared between calls.
+
+    Returns
+    -------
+    starts : ndarray (2, 4)
+        Coordinates of the corner at which each edge starts.
+    edges : ndarray (2, 4)
+        Vector along each edge, from its start to the next corner.
+    """
+    # Initialise rotation matrix, acting on column vectors.
+    rotation_matrix = np.asarray([[np.cos(rotation), -np.sin(rotation)], [np.sin(rotation), np.cos(rotation)]])
+    # Convert inputs to the four corners of the rectangle, one per column. Each
+    # edge starts at a corner and ends at the next one (anti-clockwise).
+    starts = np.asarray([[origin_x], [origin_y]]) + np.dot(rotation_matrix, np.asarray([[0, width, width, 0], [0, 0, height, height]]))
+    edges = np.roll(starts, -1, axis=1) - starts
+    starts.flags.writeable = False
+    edges.flags.writeable = False
+    return starts, edges
+
+def _rect_residual(pt, origin_x, origin_y, width, height, rotation):
+    """
+    Unchecked form of `lst_dist_from_rect` used as the residual when fitting,
+    where pt has already been validated.
+    """
+    return _rect_dist(pt, *_rect_edges(float(origin_x), float(origin_y), float(width), float(height), float(rotation)))
+
+def _rect_dist(pt, starts, edges):
+    """
+    Kernel of `lst_dist_from_rect`, computing the distance of m points from the
+    nearest of the four edges. No input checking is done here, so that it can
+    be called directly from within the fitting loop.
+
+    The points are processed in blocks of `_RECT_DIST_BLOCK`, so that the
+    (2, 4, block) intermediate arrays stay in cache for large scans.
+
+    Parameters
+    ----------
+    pt : ndarray (2, m)
+        Coordinates of m points for which the distance will be calculated.
+    starts : ndarray (2, 4)
+        Coordinates of the corner at which each edge starts.
+    edges : ndarray (2, 4)
+        Vector along each edge, from its start to the next corner.
+
+    Returns
+    -------
+    dist : ndarray (m,)
+        Distances of the points from the nearest edge in the rectangle.
+    """
+    if pt.shape[1] <= _RECT_DIST_BLOCK:
+        return _rect_dist_block(pt, starts, edges)
+    dist = np.empty(pt.shape[1])
+    def fill(i):
+        dist[i:i+_RECT_DIST_BLOCK] = _rect_dist_block(pt[:, i:i+_RECT_DIST_BLOCK], starts, edges)
+    blocks = range(0, pt.shape[1], _RECT_DIST_BLOCK)
+    # Blocks are independent and numpy releases the GIL while working on them,
+    # so spread them across threads when there are enough to go round.
+    if len(blocks) >= 2 * _RECT_DIST_THREADS > 2:
+        list(_rect_dist_pool().map(fill, blocks))
+    else:
+        for i in blocks:
+            fill(i)
+    return dist
+
+@lru_cache(maxsize=1)
+def _rect_dist_pool():
+    """
+    Thread pool used by `_rect_dist`, created the first time it is needed.
+    """
+    return ThreadPoolExecutor(max_workers=_RECT_DIST_THREADS)
+
+def _rect_dist_block(pt, starts, edges):
+    """
+    Distance of a block of points from the nearest edge of the rectangle. See
+    `_rect_dist`.
+    """
+    # Distance to all four segments at once: d has shape (2, 4, m).
+    d = pt[:, np.newaxis, :] - starts[:, :, np.newaxis]
+    # Location of the nearest point on each edge in % of segment length,
+    # limited to the segment itself.
+    nearest_perc = np.einsum('ij,ijm->jm', edges, d)
+    nearest_perc /= np.einsum('ij,ij->j', edges, edges).reshape(-1, 1)
+    np.clip(nearest_perc, 0., 1., out=nearest_perc)
+    d -= edges[:, :, np.newaxis] * nearest_perc[np.newaxis, :, :]
+    # Reuse the (4, m) buffer for the squared distances and reduce over the
+    # edges before taking the root, so only m square roots are needed.
+    dist = np.einsum('ijm,ijm->jm', d, d, out=nearest_perc)
+    dist = np.minimum.reduce(dist, axis=0)
+    return np.sqrt(dist, out=dist)
+
+def _rect_dist_jac(pt, origin_x, origin_y, width, height, rotation):
+    """
+    Jacobian of `lst_dist_from_rect` with respect to the parameters of the
+    rectangle. The distance of each point is determined by its nearest point on
+    the nearest edge, so the derivative of the distance is the projection of
+    the derivative of this nearest point onto the unit vector from it to the
+    point.
+
+    Parameters
+    ----------
+    pt : ndarray (2, m)
+        Coordinates of m points.
+    origin_x, origin_y, width, height, rotation : float
+        Parameters of the rectangle, as in `lst_dist_from_rect`.
+
+    Returns
+    -------
+    jac : ndarray (m, 5)
+        Derivative of the distance of each point with respect to origin_x,
+        origin_y, width, height and rotation.
+    """
+    origin_x, origin_y, width, height, rotation = float(origin_x), float(origin_y), float(width), float(height), float(rotation)
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    starts, edges = _rect_edges(origin_x, origin_y, width, height, rotation)
+    # Corners of the rectangle in units of width and height before rotation.
+    unit = np.asarray([[0., 1., 1., 0.], [0., 0., 1., 1.]])
+    d = pt[:, np.newaxis, :] - starts[:, :, np.newaxis]
+    nearest_perc = np.einsum('ij,ijm->jm', edges, d)
+    nearest_perc /= np.einsum('ij,ij->j', edges, edges).reshape(-1, 1)
+    np.clip(nearest_perc, 0., 1., out=nearest_perc)
+    d -= edges[:, :, np.newaxis] * nearest_perc[np.newaxis, :, :]
+    # Select the nearest edge for each point.
+    idx = np.arange(pt.shape[1])
+    nearest_edge = np.argmin(np.einsum('ijm,ijm->jm', d, d), axis=0)
+    residual = d[:, nearest_edge, idx]
+    t = nearest_perc[nearest_edge, idx]
+    dist = np.sqrt(np.einsum('im,im->m', residual, residual))
+    unit_residual = np.zeros(residual.shape)
+    np.divide(residual, dist, out=unit_residual, where=dist > 0)
+    # Nearest point on the edge, in units of width and height before rotation.
+    unit_nearest = unit[:, nearest_edge] + (np.roll(unit, -1, axis=1) - unit)[:, nearest_edge] * t
+    local_nearest = unit_nearest * np.asarray([[width], [height]])
+    
+    jac = np.empty((pt.shape[1], 5))
+    jac[:, 0] = -unit_residual[0]
+    jac[:, 1] = -unit_residual[1]
+    jac[:, 2] = -(unit_residual[0] * cos + unit_residual[1] * sin) * unit_nearest[0]
+    jac[:, 3] = -(unit_residual[1] * cos - unit_residual[0] * sin) * unit_nearest[1]
+    jac[:, 4] = -(unit_residual[0] * (-sin * local_nearest[0] - cos * local_nearest[1]) + 
+                  unit_residual[1] * ( cos * local_nearest[0] - sin * local_nearest[1]))
+    return jac
+
+def _dist_from_lines(pt, params):
+    """
+    Distance of a single point from each of K line segments, as in
+    `dist_from_line` but evaluated for all of the segments at once.
+
+    Parameters
+    ----------
+    pt : ndarray (2,)
+        Coordinates of the point.
+    params : ndarray (4, K)
+        Parameters (start_x, start_y, end_x, end_y) of each segment, one per
+        column.
+
+    Returns
+    -------
+    dist : ndarray (K,)
+        Distance of the point from each segment.
+    """
+    start_x, start_y, end_x, end_y = params
+    return np.sqrt(_segment_dist_sq(pt, start_x, start_y, end_x - start_x, end_y - start_y))
+
+def _dist_from_rects(pt, params):
+    """
+    Distance of a single point from the nearest edge of each of K rectangles,
+    as in `lst_dist_from_rect` but evaluated for all of the rectangles at once.
+
+    Parameters
+    ----------
+    pt : ndarray (2,)
+        Coordinates of the point.
+    params : ndarray (5, K)
+        Parameters (origin_x, origin_y, width, height, rotation) of each
+        rectangle, one per column.
+
+    Returns
+    -------
+    dist : ndarray (K,)
+        Distance of the point from the nearest edge of each rectangle.
+    """
+    origin_x, origin_y, width, height, rotation = params
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    # Corners of each rectangle before rotation, with shape (4, K). Each edge
+    # starts at a corner and ends at the next one (anti-clockwise).
+    unit_x = np.asarray([[0.], [1.], [1.], [0.]]) * width
+    unit_y = np.asarray([[0.], [0.], [1.], [1.]]) * height
+    starts_x = origin_x + cos * unit_x - sin * unit_y
+    starts_y = origin_y + sin * unit_x + cos * unit_y
+    edges_x = np.roll(starts_x, -1, axis=0) - starts_x
+    edges_y = np.roll(starts_y, -1, axis=0) - starts_y
+    return np.sqrt(np.min(_segment_dist_sq(pt, starts_x, starts_y, edges_x, edges_y), axis=0))
+
+def _segment_dist_sq(pt, starts_x, starts_y, edges_x, edges_y):
+    """
+    Squared distance of a single point from segments with the given starts and
+    edge vectors, which may be arrays of any (matching) shape. A degenerate
+    segment is treated as a single point.
+    """
+    d_x, d_y = pt[0] - starts_x, pt[1] - starts_y
+    length_sq = edges_x * edges_x + edges_y * edges_y
+    nearest_perc = np.zeros(np.shape(length_sq))
+    np.divide(d_x * edges_x + d_y * edges_y, length_sq, out=nearest_perc, where=length_sq > 0)
+    np.clip(nearest_perc, 0., 1., out=nearest_perc)
+    d_x -= edges_x * nearest_perc
+    d_y -= edges_y * nearest_perc
+    return d_x * d_x + d_y * d_y
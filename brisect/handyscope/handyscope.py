@@ -38,7 +38,7 @@ class Handyscope:
     reading data without additional setup.
     """
     #%% Attributes
-    __slots__ = ('gen', 'scp')
+    __slots__ = ('gen', 'scp', '_active_idx', '_record_time')
     
     #%% Initialisation function.
     def __init__(self,
@@ -56,29 +56,31 @@ class Handyscope:
             output_channel_coupling: int = ltp.CK_ACV,
         ):
         ltp.device_list.update()
-        if find_gen(ltp.device_list) is None or find_scp(ltp.device_list) is None:
+        # Keep the devices opened while searching, rather than opening them
+        # again.
+        gen_idx, gen = _open_gen(ltp.device_list)
+        scp_idx, scp = _open_scp(ltp.device_list)
+        if gen is None or scp is None:
             raise RuntimeError("No handyscope found! Please connect and make sure drivers are the right version.")
-        hstype = ltp.device_list.get_item_by_index(find_gen(ltp.device_list))._get_name_shortest()
-        self.gen = ltp.device_list.get_item_by_index(find_gen(ltp.device_list)).open_generator()
-        self.scp = ltp.device_list.get_item_by_index(find_scp(ltp.device_list)).open_oscilloscope()
+        hstype = ltp.device_list.get_item_by_index(gen_idx)._get_name_shortest()
+        self.gen = gen
+        self.scp = scp
         
         #%% Initialise oscilloscope. We'll probably need sample_frequency for 
         # everything, so start with the scope.
         
         # Do all the channel stuff first, to ensure that sample_frequency is 
         # what we want it to be later.
-        if not isinstance(output_active_channels, list):
-            output_active_channels = [output_active_channels]
-        for idx, ch in enumerate(self.scp.channels):
-            if output_active_channels[0] == -1 or idx in output_active_channels:
+        if isinstance(output_channel_coupling, str):
+            output_channel_coupling = mode_dict[output_channel_coupling]
+        for ch, enabled in zip(self.scp.channels, _channel_mask(output_active_channels, len(self.scp.channels))):
+            if enabled:
                 ch.enabled  = True
                 ch.range    = output_range
-                if isinstance(output_channel_coupling, str):
-                    ch.coupling = mode_dict[output_channel_coupling]
-                else:
-                    ch.coupling = output_channel_coupling
+                ch.coupling = output_channel_coupling
             else:
                 ch.enabled  = False
+        self._update_active_idx()
         self.scp.sample_frequency = output_sample_frequency
         if isinstance(output_measure_mode, str):
             self.scp.measure_mode = mode_dict[output_measure_mode]
@@ -86,6 +88,7 @@ class Handyscope:
             self.scp.measure_mode = output_measure_mode
         self.scp.resolution       = output_resolution
         self.scp.record_length    = int(output_record_length)
+        self._update_record_time()
         
         #%% Initialise generator.
         if isinstance(input_signal_type, str):
@@ -103,19 +106,12 @@ class Handyscope:
         elif input_signal_type == "multiplex":
             if not isinstance(input_frequency, list):
                 raise TypeError("Input frequency must be a list of floats for arbitrary signal generation")
-            if len(input_amplitude) != len(input_frequency):
-                if len(input_amplitude) < len(input_frequency):
-                    input_amplitude = [input_amplitude[i%len(input_amplitude)] for i in range(len(input_frequency))]
-                else:
-                    input_amplitude = input_amplitude[:len(input_frequency)]
+            # Repeat or truncate amplitudes so there is one per frequency.
+            input_amplitude = np.resize(np.asarray(input_amplitude, dtype=float), len(input_frequency))
                     
             self.gen.frequency_mode = ltp.FM_SAMPLEFREQUENCY
             self.gen.frequency = self.scp.sample_frequency
-            pts = np.linspace(0, (self.scp.record_length-1)/self.gen.frequency, self.scp.record_length)
-            sig = np.zeros(self.scp.record_length)
-            for amp, freq in zip(input_amplitude, input_frequency):
-                sig += amp * np.sin(2*np.pi*freq * pts)
-            self.set_data(sig)
+            self.set_data(multiplex_signal(input_amplitude, input_frequency, self.gen.frequency, self.scp.record_length))
         
         # Any other arbitrary signal, relies on the user setting the signal later.
         elif input_signal_type == "arbitrary":
@@ -149,7 +145,7 @@ class Handyscope:
             DESCRIPTION.
 
         """
-        settings = read_settings(filename)
+        settings = _normalize_settings(read_settings(filename))
             
         return cls(
             settings["generator"]["signal"]["frequency"],
@@ -205,17 +201,34 @@ class Handyscope:
             elif kw in scp_dict.keys():
                 self.scp.__setattr__(scp_dict[kw], kwargs[kw])
             elif kw == "output_active_channels":
-                for idx, ch in enumerate(self.scp.channels):
-                    if kwargs[kw] == -1 or idx in kwargs[kw]:
-                        ch.enabled = True
-                    else:
-                        ch.enabled = False
+                for ch, enabled in zip(self.scp.channels, _channel_mask(kwargs[kw], len(self.scp.channels))):
+                    ch.enabled = enabled
+                self._update_active_idx()
             elif kw == "output_range":
                 for idx, ch in enumerate(self.scp.channels):
                     ch.range = kwargs[kw]
             elif kw == "output_channel_coupling":
                 for idx, ch in enumerate(self.scp.channels):
                     ch.coupling = kwargs[kw]
+        # The sample frequency may have changed with the record length or the
+        # enabled channels.
+        self._update_record_time()
+    
+    def _update_active_idx(self):
+        """
+        Store the indices of the enabled channels, so that they do not need to
+        be looked up on every call to get_record. Must be called whenever the
+        enabled channels are changed.
+        """
+        self._active_idx = tuple(idx for idx, ch in enumerate(self.scp.channels) if ch.enabled)
+    
+    def _update_record_time(self):
+        """
+        Store the time taken to record, so that the oscilloscope does not need
+        to be asked for it on every call to get_record. Must be called whenever
+        the record length or sample frequency are changed.
+        """
+        self._record_time = self.scp.record_length / self.scp.sample_frequency
     
     def set_data(self, signal):
         """ 
@@ -228,15 +241,43 @@ class Handyscope:
         signal = np.squeeze(signal)
         if len(signal.shape) != 1 or signal.shape[0] != self.scp.record_length:
             raise ValueError("Handyscope.set_data(): signal has the wrong size: it should be arraylike with length {}.".format(self.scp.record_length))
-        self.gen.set_data(array.array('f', signal))
+        # Copy the raw float32 bytes, rather than building the array one
+        # element at a time.
+        self.gen.set_data(array.array('f', np.ascontiguousarray(signal, dtype=np.float32).tobytes()))
     
     def get_record(self, channels: list[int] = [-1]):
-        """ Do all the data collection, so initialisation required outside. """
+        """
+        Do all the data collection, so initialisation required outside. Data is
+        returned in single precision, as recorded by the oscilloscope.
+        """
+        return self.get_record_into(self.empty_record(channels), channels)
+    
+    def empty_record(self, channels: list[int] = [-1]):
+        """
+        Allocate an array which a record of channels can be written into by
+        get_record_into().
+        """
+        n_channels = len(self._active_idx) if channels[0] == -1 else len(channels)
+        return np.empty((n_channels, self.scp.record_length), dtype=np.float32)
+    
+    def get_record_into(self, out: np.ndarray, channels: list[int] = [-1]):
+        """
+        As get_record(), but write the data into out and return it, so that an
+        array allocated once (e.g. by empty_record()) can be reused for every
+        record. out should have one row per channel returned and
+        record_length columns.
+        """
         self.scp.start()
+        start = time.perf_counter()
         self.gen.start()
         
+        # Sleep through most of the acquisition in one go, then poll without
+        # sleeping (only yielding to other threads) so that the data is
+        # collected as soon as it is ready. If the data is well overdue, back
+        # off so that the oscilloscope is not flooded with requests.
+        time.sleep(max(0., self._record_time - 1e-3))
         while not self.scp.is_data_ready:
-            time.sleep(.01)
+            time.sleep(0. if time.perf_counter() - start < 2*self._record_time else 1e-3)
         
         data = self.scp.get_data()
         
@@ -244,48 +285,128 @@ class Handyscope:
         
         # Return all active channels.
         if channels[0] == -1:
-            np_data = np.empty((sum(self.scp._active_channels), self.scp.record_length))
-            idx = 0
-            for ch, active in enumerate(self.scp._active_channels):
-                if active:
-                    np_data[idx, :] = np.asarray(data[ch])
-                    idx += 1
-            return np_data
-        # Return the requested channels, even if inactive.
+            for row, ch in enumerate(self._active_idx):
+                out[row, :] = data[ch]
+        # Return the requested channels, even if inactive. Inactive channels
+        # are left as zeros.
         else:
-            np_data = np.empty((len(channels), self.scp.record_length))
-            for idx, ch in enumerate(channels):
-                if self.scp._active_channels[ch]:
-                    np_data[idx, :] = np.asarray(data[ch])
+            for row, ch in enumerate(channels):
+                if ch in self._active_idx:
+                    out[row, :] = data[ch]
                 else:
-                    np_data[idx, :] = np.zeros((self.scp.record_length))
-            return np.asarray(data)
+                    out[row, :] = 0
+        return out
+
+
+
+#%% Signal helper functions.
+def multiplex_signal(
+        amplitudes: list[float],
+        frequencies: list[float],
+        sample_frequency: float,
+        record_length: int,
+        block_size: int = 65536,
+    ) -> np.ndarray[float]:
+    """
+    Returns the sum of sine waves with the given amplitudes and frequencies,
+    sampled at sample_frequency. The sines of all frequencies are computed
+    together for blocks of samples and summed with a matrix product, so that
+    there is no loop over the frequencies and the working array stays small.
 
+    Parameters
+    ----------
+    amplitudes : list[float]
+        Amplitude of each sine wave. Must have the same length as frequencies.
+    frequencies : list[float]
+        Frequency (Hz) of each sine wave.
+    sample_frequency : float
+        Sampling frequency (Hz) of the signal.
+    record_length : int
+        Number of samples in the signal.
+    block_size : int, optional
+        Number of samples computed at once. The default is 65536.
 
+    Returns
+    -------
+    sig : ndarray (record_length,)
+        Multiplexed signal, in single precision as used by the generator. The
+        phase is computed in double precision, as single precision is not
+        accurate enough for the phase of long records.
+    """
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    omega = (2*np.pi) * np.asarray(frequencies, dtype=float)
+    if amplitudes.shape != omega.shape:
+        raise ValueError("multiplex_signal: amplitudes and frequencies must have the same length.")
+    pts = np.arange(record_length, dtype=float) / sample_frequency
+    sig = np.empty(record_length, dtype=np.float32)
+    for i in range(0, record_length, block_size):
+        sig[i:i+block_size] = amplitudes @ np.sin(np.multiply.outer(omega, pts[i:i+block_size]))
+    return sig
 
 #%% libtiepie helper functions.
+def _normalize_settings(settings: dict) -> dict:
+    """
+    Converts the oscilloscope mode and coupling in settings from their names to
+    libtiepie's constants, so that they are passed straight to the device. The
+    signal type is left as a name, as "multiplex" and "arbitrary" share the
+    same constant but are set up differently.
+    """
+    for key in ("mode", "coupling"):
+        value = settings["oscilloscope"].get(key)
+        if isinstance(value, str):
+            settings["oscilloscope"][key] = mode_dict[value]
+    return settings
+
+def _channel_mask(active_channels: list[int], num_channels: int) -> list[bool]:
+    """
+    Returns whether each of num_channels channels is active. active_channels
+    may be a channel index, a list of them, or -1 (or [-1]) for all channels.
+    """
+    if not isinstance(active_channels, list):
+        active_channels = [active_channels]
+    if active_channels[0] == -1:
+        return [True] * num_channels
+    active_channels = frozenset(active_channels)
+    return [idx in active_channels for idx in range(num_channels)]
+
 def find_gen(device_list: list):
     """
     Returns the index of the item in device_list which corresponds to a
     generator.
     """
-    for idx, item in enumerate(device_list):
-        if item.can_open(ltp.DEVICETYPE_GENERATOR):
-            gen = item.open_generator()
-            if gen.signal_types and ltp.ST_ARBITRARY:
-                # del gen
-                return idx
-    return None
+    return _open_gen(device_list)[0]
 
 def find_scp(device_list: list):
     """
     Returns the index of the item in device_list which corresponds to a
     oscilloscope.
     """
+    return _open_scp(device_list)[0]
+
+def _open_gen(device_list: list):
+    """
+    Returns the index of the first item in device_list which is a generator
+    supporting arbitrary signals, along with the opened generator. Returns
+    (None, None) if there is no such item.
+    """
+    for idx, item in enumerate(device_list):
+        if item.can_open(ltp.DEVICETYPE_GENERATOR):
+            gen = item.open_generator()
+            if gen.signal_types & ltp.ST_ARBITRARY:
+                return idx, gen
+            del gen
+    return None, None
+
+def _open_scp(device_list: list):
+    """
+    Returns the index of the first item in device_list which is an
+    oscilloscope supporting block measurements, along with the opened
+    oscilloscope. Returns (None, None) if there is no such item.
+    """
     for idx, item in enumerate(device_list):
         if item.can_open(ltp.DEVICETYPE_OSCILLOSCOPE):
             scp = item.open_oscilloscope()
-            if scp.measure_modes and ltp.MM_BLOCK:
-                # del scp
-                return idx
-    return None
\ No newline at end of file
+            if scp.measure_modes & ltp.MM_BLOCK:
+                return idx, scp
+            del scp
+    return None, None
@@ -10,6 +10,7 @@ anything too much more extensive.
 """
 import csv
 from importlib.resources import files
+import math
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
@@ -87,18 +88,22 @@ def dict_merge(dict1: dict, dict2: dict):
     from dict2 are merged into dict1, taking dict2's value over dict1's in
     conflicts.
     """
-    for k, v in dict2.items():
-        # Typical dictionary-merging behaviour is to overwrite the values in
-        # dict1 with those in dict2. If the value is a dictionary, the entire
-        # thing is overwritten rather than just duplicate terms. To preserve
-        # values in dict1[k] which are not present in dict2[k], recursively
-        # call dict_merge when we find a dictionary.
-        if (k in dict1 and isinstance(dict1[k], dict) and isinstance(dict2[k], dict)):
-            dict_merge(dict1[k], dict2[k])
-        # Either we do not have a dictionary, or this item is not a dictionary
-        # in dict1, thus we want to overwrite it anyway.
-        else:
-            dict1[k] = dict2[k]
+    # Sub-dictionaries still to be merged, as (destination, source) pairs.
+    stack = [(dict1, dict2)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in src.items():
+            # Typical dictionary-merging behaviour is to overwrite the values in
+            # dict1 with those in dict2. If the value is a dictionary, the entire
+            # thing is overwritten rather than just duplicate terms. To preserve
+            # values in dst[k] which are not present in src[k], merge them as
+            # well when we find a dictionary.
+            if (k in dst and isinstance(dst[k], dict) and isinstance(v, dict)):
+                stack.append((dst[k], v))
+            # Either we do not have a dictionary, or this item is not a
+            # dictionary in dst, thus we want to overwrite it anyway.
+            else:
+                dst[k] = v
 
 def save_csv(
         filename: str,
@@ -135,11 +140,13 @@ def save_csv(
         filename += f" ({idx})"
     
     print(f"Saving {filename}.csv ...")
-    with open(f"{filename}.csv", 'w', newline='') as csvfile:
+    # Use a large buffer so that long scans are written in few, large chunks.
+    with open(f"{filename}.csv", 'w', newline='', buffering=1<<20) as csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow([f"x ({xunits})", f"y ({yunits})"] + ["{}".format(label) for label in zlabel])
-        for idx in range(x.shape[0]):
-            csvwriter.writerow([x[idx], y[idx]] + list(z[idx, :]))
+        # Convert each column to Python scalars in one go and let the writer
+        # iterate over the rows, rather than building a list for each row.
+        csvwriter.writerows(zip(x.tolist(), y.tolist(), *z.T.tolist()))
             
 def plot_data(
         filename: str,
@@ -183,9 +190,21 @@ def plot_data(
 #%% Useful data analysis functions.
 def rms(x: np.ndarray[float]):
     """
-    Compute the root-mean-square of a numpy vector.
+    Compute the root-mean-square of a numpy vector. Uses a dot product so that
+    no squared copy of x is made.
     """
-    return np.sqrt(np.mean(np.asarray(x)**2))
+    x = np.asarray(x).reshape(-1)
+    return np.sqrt(np.dot(x, x) / x.size)
+
+def rms_batch(records: np.ndarray[float]) -> np.ndarray[float]:
+    """
+    Compute the root-mean-square of each record in a batch, where records has
+    shape (K, ...) and the rms is taken over everything but the first axis.
+    All K values are computed in one pass.
+    """
+    records = np.asarray(records)
+    records = records.reshape(records.shape[0], -1)
+    return np.sqrt(np.einsum('ij,ij->i', records, records) / records.shape[1])
 
 def within_radius(
         origin: np.ndarray[float],
@@ -208,10 +227,26 @@ def within_radius(
     elif len(coords.shape) > 2:
         raise ValueError("within_radius: coords has the wrong shape.")
         
-    distance = np.linalg.norm(coords - origin, axis=0)
-    if len(distance) == 1:
-        distance = distance[0]
-    return distance < radius
+    # Compare squared distances, so no square roots are needed.
+    diff = coords - origin
+    distance_sq = np.einsum('ij,ij->j', diff, diff)
+    if len(distance_sq) == 1:
+        distance_sq = distance_sq[0]
+    return distance_sq < radius * radius
+
+def within_radius_sq(
+        origin: np.ndarray[float],
+        coord: np.ndarray[float],
+        radius_sq: float
+    ) -> bool:
+    """ 
+    Checks whether a single point is within a radius of the origin, given the
+    square of the radius. Unlike `within_radius`, no input checking is done,
+    so that it is cheap enough to use as a loop condition: origin and coord
+    must contain the same number of coordinates (of any shape).
+    """
+    diff = np.ravel(origin) - np.ravel(coord)
+    return float(np.dot(diff, diff)) < radius_sq
 
 def grid_sweep_coords(
         separation: float,
@@ -253,111 +288,71 @@ def grid_sweep_coords(
         2D coordinates to be swept out. 
     """
     
-    coords = np.zeros((0, 2))
-    x, y = x_init, y_init
+    cos, sin = math.cos(rotation), math.sin(rotation)
+    # Coordinates are built in the frame of the rectangle as (u, v), where u is
+    # the distance along the width and v along the height, and are mapped to
+    # global coordinates at the end.
     
     #%% Snake up through y. Grid will form in the axes of the square. Separation
     # between rows will be equal to separation, length will span the full width.
-    # Terminate on the row before we leave the limits of the geometry.
-    idx = 0
-    while y - (y_init + height * np.cos(rotation)) < eps:
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move from left -> right
-        if idx%2 == 0:
-            x += width * np.cos(rotation)
-            y += width * np.sin(rotation)
-        # Move from right -> left
-        else:
-            x -= width * np.cos(rotation)
-            y -= width * np.sin(rotation)
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move up to the next row
-        x += separation * np.sin(rotation)
-        y += separation * np.cos(rotation)
-        
-        idx += 1
-        
+    # Terminate on the row before we leave the limits of the geometry. Rows
+    # start on the left when even and on the right when odd.
+    if separation * cos <= 0:
+        if -height * cos < eps:
+            raise ValueError("grid_sweep_coords: Rows never leave the rectangle. Separation must be positive and rotation within (-pi/2, pi/2).")
+        n_rows = 0
+    else:
+        # Check more rows than needed, and find the first one which is outside.
+        k = np.arange(int((abs(height * cos) + abs(width * sin) + eps) / (separation * cos)) + 3)
+        n_rows = int(np.argmin(k * (separation * cos) + (k % 2) * (width * sin) - height * cos < eps))
+    k = np.arange(n_rows)
+    row_u = (k % 2) * width
+    rows = np.empty((2*n_rows, 2))
+    rows[0::2, 0], rows[1::2, 0] = row_u, width - row_u
+    rows[0::2, 1] = rows[1::2, 1] = k * separation
+    
     # We are currently outside of the geometry. To scan the full span, do a final
-    # row at the limit.
-    if idx%2 == 0:
+    # row at the limit, which starts at the top left if there were an even
+    # number of rows and top right otherwise.
+    if n_rows%2 == 0:
         coeff = +1
-        # Top left
-        x = x_init + height * np.sin(rotation)
-        y = y_init + height * np.cos(rotation)
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move left -> right
-        x += width * np.cos(rotation)
-        y += width * np.sin(rotation)
+        final_row = [(0, height)]
+        col_u0 = width
     else:
         coeff = -1
-        # Top right
-        x = x_init + width * np.cos(rotation) + height * np.sin(rotation)
-        y = y_init + width * np.sin(rotation) + height * np.cos(rotation)
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move right -> left
-        x -= width * np.cos(rotation)
-        y -= width * np.sin(rotation)
+        final_row = [(width, height)]
+        col_u0 = 0
     
     #%% Snake back through x. x may be increasing or decreasing depending on
-    # where y terminated - check both lower and upper limits of x.
-    idx = 0
-    while x - (x_init - height * np.sin(rotation)) >= eps and x - (x_init + height * np.sin(rotation) + width * np.cos(rotation)) <= eps:
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move top -> bottom
-        if idx%2 == 0:
-            x -= height * np.sin(rotation)
-            y -= height * np.cos(rotation)
-        # Move bottom -> top
-        else:
-            x += height * np.sin(rotation)
-            y += height * np.cos(rotation)
-        coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # Move along to next column
-        x -= coeff * separation * np.cos(rotation)
-        y -= coeff * separation * np.sin(rotation)
-        
-        idx += 1
-        
-    # Do the final column at the limit.
-    # If x is increasing with subsequent columns
-    if coeff == -1:
-        # If we terminated at the top
-        if idx%2 == 0:
-            x = x_init + width * np.cos(rotation) + height * np.sin(rotation)
-            y = y_init + width * np.sin(rotation) + height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-            # Move top -> bottom
-            x -= height * np.sin(rotation)
-            y -= height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # If we terminated at the bottom
-        else:
-            x = x_init + width * np.cos(rotation)
-            y = y_init + width * np.sin(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-            # Move bottom -> top
-            x += height * np.sin(rotation)
-            y += height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-    # If x is decreasing with subsequent columns
+    # where y terminated - check both lower and upper limits of x. Columns move
+    # top -> bottom when even and bottom -> top when odd.
+    def col_x(j):
+        return (col_u0 - j * coeff * separation) * cos + (j % 2 == 0) * height * sin
+    def col_inside(x):
+        return (x + height * sin >= eps) & (x - height * sin - width * cos <= eps)
+    if separation * cos == 0:
+        if col_inside(col_x(0)) and col_inside(col_x(1)):
+            raise ValueError("grid_sweep_coords: Columns never leave the rectangle. Separation must be positive and rotation within (-pi/2, pi/2).")
+        n_cols = 0 if not col_inside(col_x(0)) else 1
+    else:
+        j = np.arange(int((2 * abs(width * cos) + 4 * abs(height * sin) + 2 * eps) / abs(separation * cos)) + 3)
+        n_cols = int(np.argmin(col_inside(col_x(j))))
+    j = np.arange(n_cols)
+    col_v = (j % 2 == 0) * height
+    cols = np.empty((2*n_cols, 2))
+    cols[0::2, 0] = cols[1::2, 0] = col_u0 - j * coeff * separation
+    cols[0::2, 1], cols[1::2, 1] = col_v, height - col_v
+    
+    # Do the final column at the limit, on the right if x is increasing with
+    # subsequent columns and on the left otherwise.
+    final_u = width if coeff == -1 else 0
+    if n_cols%2 == 0:
+        final_col = [(final_u, height), (final_u, 0)]
     else:
-        # If we terminated at the top
-        if idx%2 == 0:
-            x = x_init + height * np.sin(rotation)
-            y = y_init + height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-            # Move top -> bottom
-            x -= height * np.sin(rotation)
-            y -= height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-        # If we terminated at the bottom
-        else:
-            x = x_init
-            y = y_init
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
-            # Move bottom -> top
-            x += height * np.sin(rotation)
-            y += height * np.cos(rotation)
-            coords = np.append(coords, np.reshape([x, y], (1, 2)), axis=0)
+        final_col = [(final_u, 0), (final_u, height)]
     
-    return coords
\ No newline at end of file
+    # Map all of the coordinates to the global frame at once, with
+    # x = x_init + u*cos + v*sin and y = y_init + u*sin + v*cos.
+    transform = np.asarray([[cos, sin], [sin, cos]])
+    local = np.concatenate((rows, final_row, cols, final_col))
+    return local @ transform.T + np.asarray([x_init, y_init])
\ No newline at end of file
@@ -6,19 +6,345 @@ Created on Mon Dec 19 15:34:27 2022
 
 A file containing functions which combine the zaber stage and the handyscope.
 """
-from . import grid_sweep_coords, rms, within_radius, fit_geometry_to_data
+from . import grid_sweep_coords, rms, rms_batch, within_radius_sq, fit_geometry_to_data
+from .analysis import _dist_from_lines, _dist_from_rects, _rect_edges
 # N.B. only used for type hints. If a stage other than the one in .zaberstage
 # is used, that's fine as long as it follows the standardised format.
 from .handyscope import Handyscope
-from .zaberstage import Stage
+from .zaberstage import Stage, l2v_units
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy import fft
+from scipy.spatial import cKDTree
 import time
 from typing import Callable, Union, Tuple
 import warnings
 from zaber_motion import Units
 
+class _ColAppender:
+    """
+    Accumulates blocks of columns into a 2D array. Capacity is doubled when it
+    runs out, so that appending is amortised O(1) per column rather than
+    copying all of the data collected so far on every append.
+    """
+    __slots__ = ("buf", "n")
+    
+    def __init__(self, rows: int, capacity: int = 1024, dtype: type = float):
+        self.buf = np.empty((rows, capacity), dtype=dtype)
+        self.n = 0
+    
+    def extend(self, block: np.ndarray):
+        """
+        Append block (rows, k) to the end of the columns stored so far.
+        """
+        block = np.asarray(block).reshape((self.buf.shape[0], -1))
+        k = block.shape[1]
+        if self.n + k > self.buf.shape[1]:
+            self._grow(self.n + k)
+        self.buf[:, self.n:self.n+k] = block
+        self.n += k
+    
+    def append(self, column):
+        """
+        Append a single column, given as a sequence of length rows (or a
+        scalar when there is one row). Cheaper than extend() when adding one
+        column at a time, as nothing needs to be converted or reshaped.
+        """
+        if self.n == self.buf.shape[1]:
+            self._grow(self.n + 1)
+        self.buf[:, self.n] = column
+        self.n += 1
+    
+    def _grow(self, capacity: int):
+        """
+        Reallocate the buffer with room for at least capacity columns.
+        """
+        new = np.empty((self.buf.shape[0], max(2*self.buf.shape[1], capacity)), dtype=self.buf.dtype)
+        new[:, :self.n] = self.buf[:, :self.n]
+        self.buf = new
+    
+    def view(self) -> np.ndarray:
+        """
+        Returns a view of the columns stored so far. This is invalidated by
+        the next call to extend().
+        """
+        return self.buf[:, :self.n]
+    
+    def finalize(self) -> np.ndarray:
+        """
+        Returns a copy of the columns stored so far, trimmed to size.
+        """
+        return self.buf[:, :self.n].copy()
+
+class _LivePlot:
+    """
+    A single figure which is updated in place while scanning, rather than
+    drawing a new figure for every sample. Redraws are limited to one every
+    `interval` seconds, so that drawing does not hold up acquisition: samples
+    arriving in between are picked up by the next redraw.
+    
+    Scans should get their plot from shared(), so that consecutive scans (e.g.
+    each line of a sweep) draw into the same figure rather than opening a new
+    one each time.
+    """
+    __slots__ = ("fig", "ax", "line", "interval", "_last_draw", "_index")
+    # The plot currently shared between scans.
+    _open = None
+    
+    def __init__(self, interval: float = .05):
+        self.fig, self.ax = plt.subplots(figsize=(12,5), dpi=100)
+        self.line, = self.ax.plot([], [])
+        self.interval = interval
+        self._last_draw = -np.inf
+        # Default x-axis, grown as needed so it is not rebuilt on every redraw.
+        self._index = np.arange(0)
+        plt.show(block=False)
+    
+    @classmethod
+    def shared(cls):
+        """
+        Returns the plot shared between scans, opening a new one if there is
+        none or if it has been closed.
+        """
+        if cls._open is None or not plt.fignum_exists(cls._open.fig.number):
+            cls._open = cls()
+        return cls._open
+    
+    @classmethod
+    def close_shared(cls):
+        """
+        Closes the plot shared between scans, if it is open.
+        """
+        if cls._open is not None:
+            plt.close(cls._open.fig)
+            cls._open = None
+    
+    def update(self, ydata: np.ndarray, xdata: np.ndarray = None, force: bool = False):
+        """
+        Set the data plotted to ydata against xdata (default is the index of
+        each value), redrawing if `interval` has passed since the last redraw
+        or if force is True.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_draw < self.interval:
+            return
+        self._last_draw = now
+        if xdata is None:
+            if len(ydata) > len(self._index):
+                self._index = np.arange(max(2*len(self._index), len(ydata)))
+            xdata = self._index[:len(ydata)]
+        self.line.set_data(xdata, ydata)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events()
+
+class _SpectrumPlot:
+    """
+    A spectrum against fixed frequencies, optionally with an inset showing the
+    bins in a narrower range, which is updated in place while scanning. Only
+    the spectrum changes between samples, so the axes are drawn once and
+    cached, and each update blits just the lines on top of them. The axes are
+    only redrawn when the spectrum outgrows their y-limits.
+    
+    As with _LivePlot, scans should get their plot from shared().
+    """
+    __slots__ = ("fig", "axes", "lines", "freq", "bins", "_backgrounds")
+    # The plot currently shared between scans.
+    _open = None
+    
+    def __init__(self, freq: np.ndarray[float], bins: slice = None):
+        self.fig, ax = plt.subplots(figsize=(12,5), dpi=100)
+        self.freq = freq
+        self.axes, self.bins = [ax], [slice(None)]
+        if bins is not None:
+            self.axes.append(self.fig.add_axes([.35, .25, .525, .6]))
+            self.bins.append(bins)
+        self.lines = [
+            ax.plot(freq[b]*1e-6, np.zeros(freq[b].shape), animated=True)[0]
+            for ax, b in zip(self.axes, self.bins)
+        ]
+        self._backgrounds = None
+        # Re-cache the axes whenever the figure is drawn in full, e.g. if the
+        # window is resized.
+        self.fig.canvas.mpl_connect("draw_event", self._cache_backgrounds)
+        plt.show(block=False)
+    
+    @classmethod
+    def shared(cls, freq: np.ndarray[float], bins: slice = None):
+        """
+        Returns the plot shared between scans if it is still open and shows
+        the same frequencies and bins, else replaces it with a new one.
+        """
+        plot = cls._open
+        if (plot is None or not plt.fignum_exists(plot.fig.number)
+                or plot.bins[1:] != ([] if bins is None else [bins])
+                or not np.array_equal(plot.freq, freq)):
+            cls.close_shared()
+            cls._open = cls(freq, bins)
+        return cls._open
+    
+    @classmethod
+    def close_shared(cls):
+        """
+        Closes the plot shared between scans, if it is open.
+        """
+        if cls._open is not None:
+            plt.close(cls._open.fig)
+            cls._open = None
+    
+    def _cache_backgrounds(self, event=None):
+        self._backgrounds = [self.fig.canvas.copy_from_bbox(ax.bbox) for ax in self.axes]
+    
+    def update(self, spectrum: np.ndarray[complex]):
+        """
+        Plot the magnitude of spectrum, which has one value per frequency.
+        """
+        magnitude = np.abs(spectrum)
+        redraw = self._backgrounds is None
+        for ax, line, b in zip(self.axes, self.lines, self.bins):
+            line.set_ydata(magnitude[b])
+            # An empty inset (a band narrower than one bin) has no limit to check.
+            top = magnitude[b].max(initial=0.)
+            if top > ax.get_ylim()[1]:
+                ax.set_ylim(0, 1.1*top)
+                redraw = True
+        canvas = self.fig.canvas
+        if redraw:
+            canvas.draw()
+        # The inset is drawn over the full spectrum, so restore and draw each
+        # axes in turn before blitting the whole figure.
+        for ax, line, background in zip(self.axes, self.lines, self._backgrounds):
+            canvas.restore_region(background)
+            ax.draw_artist(line)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+def _freq_bins(freq: np.ndarray[float], freq_range: Tuple[float, float]) -> slice:
+    """
+    Slice of the sorted frequencies freq which lie within freq_range, given as
+    (lower, upper) in Hz and including both ends, or None if freq_range is
+    None. Used wherever a scan takes a freq_range, so that they all pick out
+    the same bins.
+    """
+    if freq_range is None:
+        return None
+    return slice(np.searchsorted(freq, freq_range[0], side="left"), np.searchsorted(freq, freq_range[1], side="right"))
+
+class _GeometryIndex:
+    """
+    Geometries found during a scan, for checking whether a point is near any
+    of them. Each geometry is indexed by an anchor point (the centroid of its
+    fitted vertices) and the radius about the anchor which contains those
+    vertices, and so the whole of the geometry. A KD-tree over the anchors
+    picks out the geometries which could be near a point, without missing any
+    which are. The anchors, and the parameters of
+    each profile, are stacked into contiguous arrays with one geometry per
+    column, so the tree is built without any conversion and the distances from
+    all of the candidates with the same profile are computed in one call.
+    """
+    __slots__ = ("params", "profiles", "columns", "anchors", "max_radius", "_tree")
+    # Distance of a point from each of the geometries in a (P, K) array of
+    # parameters, for each profile returned by fit_geometry_to_data.
+    _dist_fns = {"line": _dist_from_lines, "rect": _dist_from_rects}
+    # Vertices (2, V) of a geometry from its parameters, for each profile. The
+    # geometry lies within the convex hull of its vertices.
+    _vertex_fns = {
+        "line": lambda params: params.reshape(2, 2).T,
+        "rect": lambda params: _rect_edges(*(float(p) for p in params))[0],
+    }
+    
+    def __init__(self):
+        self.params   = {}
+        self.profiles = []
+        self.columns  = []
+        self.anchors    = _ColAppender(2, capacity=8, dtype=float)
+        self.max_radius = 0.
+        self._tree      = None
+    
+    def add(self, geom_profile: str, geom_params: np.ndarray):
+        """
+        Add a geometry with profile geom_profile and parameters geom_params, as
+        fitted by fit_geometry_to_data.
+        """
+        if geom_profile not in self._dist_fns:
+            raise ValueError(f"scan._GeometryIndex.add: no distance function for geometry profile \"{geom_profile}\".")
+        geom_params = np.asarray(geom_params, dtype=float).reshape(-1, 1)
+        if geom_profile not in self.params:
+            self.params[geom_profile] = _ColAppender(geom_params.shape[0], capacity=8)
+        self.profiles.append(geom_profile)
+        self.columns.append(self.params[geom_profile].n)
+        self.params[geom_profile].extend(geom_params)
+        vertices = self._vertex_fns[geom_profile](geom_params.ravel())
+        anchor = vertices.mean(axis=1).reshape(-1, 1)
+        self.anchors.extend(anchor)
+        # Only the largest radius is needed to find the candidates.
+        diff = vertices - anchor
+        self.max_radius = max(self.max_radius, float(np.sqrt(np.max(np.einsum('ij,ij->j', diff, diff)))))
+        # Rebuild the tree the next time it is needed.
+        self._tree = None
+    
+    def min_distance(self, pt: np.ndarray, margin: float) -> float:
+        """
+        Smallest distance from pt to the geometries which are within margin of
+        it, or inf if there are none.
+        """
+        if not self.profiles:
+            return np.inf
+        if self._tree is None:
+            self._tree = cKDTree(self.anchors.view().T)
+        pt = np.asarray(pt, dtype=float)[:2]
+        candidates = self._tree.query_ball_point(pt, margin + self.max_radius)
+        distance = np.inf
+        for geom_profile, params in self.params.items():
+            columns = [self.columns[k] for k in candidates if self.profiles[k] == geom_profile]
+            if columns:
+                distance = min(distance, float(np.min(self._dist_fns[geom_profile](pt, params.view()[:, columns]))))
+        return distance
+
+def _outside(lower, upper):
+    """
+    Break function which is True when a value falls strictly outside of
+    [lower, upper]. The bounds are precomputed by the caller, so that each
+    sample is checked with two float comparisons.
+    """
+    lower, upper = float(lower), float(upper)
+    return lambda v: v < lower or v > upper
+
+def _closer_to(target, other):
+    """
+    Break function which is True when a value is strictly closer to `target`
+    than to `other`, i.e. when it lies on the `target` side of the midpoint.
+    """
+    mid = .5 * (target + other)
+    if target > other:
+        return _outside(-np.inf, mid)
+    elif target < other:
+        return _outside(mid, np.inf)
+    # Equidistant from both for every value.
+    return _outside(-np.inf, np.inf)
+
+@lru_cache(maxsize=1)
+def _stage_pool():
+    """
+    Worker thread which talks to the stage in the background, created the
+    first time it is needed. A single worker keeps the requests in order.
+    """
+    return ThreadPoolExecutor(max_workers=1)
+
+def _move_async(stage: Stage, target: np.ndarray, **kwargs) -> Future:
+    """
+    Start `stage.move(target, wait_until_idle=True, **kwargs)` on the worker
+    thread. The motion takes far longer than any processing, so work which
+    does not need the stage can be done while it moves. Call `.result()` on the
+    returned future before using the stage again: this waits for it to arrive,
+    and raises any error from the move.
+    """
+    return _stage_pool().submit(stage.move, target, wait_until_idle=True, **kwargs)
+
 def domain_search(
         handyscope: Handyscope, 
         stage: Stage,
@@ -110,16 +436,21 @@ def domain_search(
     # Define break function: occurs when we move from off-geometry (low RMS) to on-geometry (high RMS). Assume that on geometry is >1% larger.
     off_geom = rms(handyscope.get_record())
     # If we ever deviate by >1%, count that as finding the geometry.
-    find_geometry = lambda v: abs(v/off_geom - 1) > detection_threshold
+    find_geometry = _outside(off_geom*(1 - detection_threshold), off_geom*(1 + detection_threshold))
     
     geoms = []
+    geom_index = _GeometryIndex()
     
     #%% Start the scan.
-    coordinates = np.zeros((len(stage.axes), 0))
-    rms_data = None
+    coordinates = _ColAppender(len(stage.axes))
+    rms_data = _ColAppender(1)
+    # Only query the stage for its position when it is not already known, i.e.
+    # after a scan has been broken off.
+    position = stage.get_position(length_units)
+    fuzzy_separation_sq = fuzzy_separation * fuzzy_separation
     for idx, step in enumerate(coords[1:, :]):
         # Loop here in case we found something and did not complete the scan.
-        while not within_radius(step, stage.get_position(length_units), fuzzy_separation):        
+        while not within_radius_sq(step, position, fuzzy_separation_sq):        
             # Do the actual scan
             scan_locs, rms_scan, break_state = linear_scan(
                 handyscope,
@@ -130,38 +461,35 @@ def domain_search(
                 velocity_units=velocity_units,
                 break_fn=find_geometry,
                 live_plot=live_plot,
-                old_val=rms_data
+                old_val=rms_data.view() if rms_data.n > 0 else None
             )
             
             # Store the data.
-            coordinates = np.append(coordinates, scan_locs, axis=1)
-            if rms_data is None:
-                rms_data = rms_scan
-            else:
-                rms_data = np.append(rms_data, rms_scan, axis=1)
+            coordinates.extend(scan_locs)
+            rms_data.extend(rms_scan)
             
+            # If the scan completed, then the stage is at the target.
+            if not break_state:
+                position = step
             # If we have found the geometry
-            if break_state:
-                # First check if we've seen it before. Work out smallest distance to
-                # each geom we've previously found.
-                distance_from_geom = []
-                for profile in geoms:
-                    geom_fn = profile[0][0]
-                    geom_params = profile[0][1]
-                    distance_from_geom.append(geom_fn(coordinates[:, -1], *geom_params)) #TODO: test that this unpacks like it should.
-                    
-                # If all of them are greater than some threshold, then it must be 
-                # new. Characterise it.
-                if np.all(np.asarray(distance_from_geom) > fuzzy_separation):
+            else:
+                # First check if we've seen it before. If the smallest distance
+                # to each geom we've previously found is greater than some
+                # threshold, then it must be new. Characterise it.
+                if geom_index.min_distance(coordinates.view()[:, -1], fuzzy_separation) > fuzzy_separation:
                     # We haven't seen it before. Characterise it.
-                    direction = coordinates[:, -1] - coordinates[:, -2]
+                    direction = coordinates.view()[:, -1] - coordinates.view()[:, -2]
                     # Work out if it has volume or not.
                     stage.move(3*fuzzy_separation*direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel", wait_until_idle=True)
-                    volume_v = rms(handyscope.get_record())
-                    stage.move(-3*fuzzy_separation*direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel", wait_until_idle=True)
+                    volume_record = handyscope.get_record()
+                    # Work out the result while moving back.
+                    moved = _move_async(stage, -3*fuzzy_separation*direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel")
+                    volume_v = rms(volume_record)
                     # Is the current RMS closer to the geometry value or the off-geom
                     # value? TODO: Check shape of rms_scan
-                    if abs(volume_v - off_geom) < abs(volume_v - rms_scan[-1]):
+                    no_volume = abs(volume_v - off_geom) < abs(volume_v - rms_scan[0, -1])
+                    moved.result()
+                    if no_volume:
                         # It has no volume
                         geom_profile = "line"
                         scan_locs, rms_scan = trace_line(
@@ -188,17 +516,110 @@ def domain_search(
                             live_plot=live_plot
                         )
                     # Store the data.
-                    coordinates = np.append(coordinates, scan_locs, axis=1)
-                    rms_data = np.append(rms_data, rms_scan, axis=1)
+                    coordinates.extend(scan_locs)
+                    rms_data.extend(rms_scan)
                     
                     # Determine what the geometry looks like.
                     geoms.append(fit_geometry_to_data(scan_locs, rms_scan, geom_profile=geom_profile))
+                    geom_index.add(geom_profile, geoms[-1][geom_profile][1])
+                
+                # The stage stopped short of the target, or has moved off to
+                # trace the geometry. Find out where it is now.
+                position = stage.get_position(length_units)
+    
+    # Every line of the search has drawn into the same live plot. Close it now
+    # that the search is finished.
+    if live_plot:
+        _LivePlot.close_shared()
     
     if len(geoms) == 1:
         geoms = geoms[0]
-    return coordinates, rms_data, geoms
+    return coordinates.finalize(), rms_data.finalize() if rms_data.n > 0 else None, geoms
 
 #%%
+def _prep_cardinal(init_direction, n_axes, caller):
+    """
+    Validates `init_direction`, zero-pads it to length `n_axes` and normalises
+    it. Returns the unit direction as a column vector, along with the four
+    cardinal directions stacked into a (4, n_axes, 1) array, each rotated 90°
+    clockwise from the last, so that rotating the cardinal direction while
+    tracing is just a change of index.
+    `caller` is used to prefix error messages.
+    """
+    init_direction = np.ravel(init_direction)
+    if init_direction.shape[0] > n_axes:
+        raise ValueError(f"{caller}: init_direction should be a vector of coodinates with length <= the number of axes.")
+    if n_axes < 2:
+        raise ValueError(f"{caller}: geometry tracing requires at least two axes.")
+    unit_dir = np.zeros((n_axes, 1))
+    unit_dir[:init_direction.shape[0], 0] = init_direction
+    unit_dir /= np.linalg.norm(unit_dir)
+    # Rotating 90° clockwise in the plane of the first two axes maps
+    # (x, y, ...) to (-y, x, ...), so just swap and negate those components.
+    directions = [unit_dir]
+    for _ in range(3):
+        rotated = directions[-1].copy()
+        rotated[0], rotated[1] = -directions[-1][1], directions[-1][0]
+        directions.append(rotated)
+    return unit_dir, np.stack(directions)
+
+def _move_tables(directions, separation):
+    """
+    Relative moves made while tracing, for each of the four cardinal
+    `directions` (4, N, 1), so that no arrays are built for every step. Each
+    table is indexed by the current cardinal direction i:
+        diag_prev : separation*(directions[i] + directions[i-1]), i.e. √(2)*d
+                    at 45° between the cardinal direction and the one -90°.
+        diag_next : separation*(directions[i] + directions[i+1]), i.e. √(2)*d
+                    at 45° between the cardinal direction and the one +90°.
+        scan_next : 3*separation*directions[i+1]
+        scan_prev : 3*separation*directions[i-1]
+    """
+    prev_dirs, next_dirs = np.roll(directions, 1, axis=0), np.roll(directions, -1, axis=0)
+    return separation*(directions + prev_dirs), separation*(directions + next_dirs), 3*separation*next_dirs, 3*separation*prev_dirs
+
+def _walk_edge(handyscope, stage, diag_prev, scan_next, card_idx, break_fn, coordinates, rms_data, length_units, velocity, velocity_units):
+    """
+    Follow a line from the current position, starting in cardinal direction
+    `card_idx` of the move tables from `_move_tables`, until it has not been seen for a full 360°, i.e.
+    we are at one end of it. Each step moves diagonally forwards and then scans
+    across the line until `break_fn` finds it again. The scans are appended to
+    the `coordinates` and `rms_data` appenders.
+    """
+    turns_since_last_seen = 0
+    while turns_since_last_seen < 4:
+        # Step once and move towards the crack.
+        stage.move(
+            # Move √(2)*d at 45°: assume we are still on the geometry. Any
+            # further and the cardinal direction would be ±90°.
+            diag_prev[card_idx],
+            length_units=length_units,
+            velocity=velocity,
+            velocity_units=velocity_units,
+            mode="rel",
+            wait_until_idle=True
+        )
+        coords, scan_data, break_state = linear_scan(
+            handyscope,
+            stage,
+            scan_next[card_idx],
+            length_units=length_units,
+            velocity=velocity,
+            velocity_units=velocity_units,
+            move_mode="rel",
+            break_fn=break_fn
+        )
+        coordinates.extend(coords)
+        rms_data.extend(scan_data)
+        # Are we still on the sample? Scan will not have broken if so.
+        if not break_state:
+            # Assume we are at a corner. Rotate cardinal direction +90°, and
+            # restart the loop.
+            card_idx = (card_idx+1) % 4
+            turns_since_last_seen += 1
+        else:
+            turns_since_last_seen = 0
+
 def trace_line(
         handyscope: Handyscope,
         stage: Stage,
@@ -255,119 +676,42 @@ def trace_line(
         this is assumed to be where we make the transition from vac to geom.
     """
     #%% Initialise start direction. Make it a unit vector of size == len(stage.axes)
-    init_direction = np.squeeze(init_direction).reshape((-1, 1))
-    if init_direction.shape[0] > len(stage.axes):
-        raise ValueError("brisect.trace_line: init_direction should be a vector of coodinates with length <= the number of axes.")
-    if len(stage.axes) < 2:
-        raise ValueError("brisect.trace_line: geometry tracing requires at least two axes.")
-    if init_direction.shape[0] != len(stage.axes):
-        init_direction = np.append(init_direction, np.zeros((len(stage.axes)-init_direction.shape[0], 1)), axis=0)
-    init_direction /= np.linalg.norm(init_direction)
+    init_direction, directions = _prep_cardinal(init_direction, len(stage.axes), "brisect.trace_line")
+    diag_prev, _, scan_next, _ = _move_tables(directions, separation)
     # Record the start position. Used to check whether we have completed tracing and terminate the loop.
     origin = stage.get_position(length_units)
-    # Define rotation matrices for changing cardinal directions later.
-    cwise = np.identity(len(stage.axes))
-    ccwise = np.identity(len(stage.axes))
-    cwise[:2, :2] = [[0, -1], [1, 0]]
-    ccwise[:2, :2] = [[0, 1], [-1, 0]]
     # Define initial cardinal direction.
-    cardinal = np.dot(cwise, init_direction)
+    card_idx = 1
     
     # Define break functions for moving over the line. Assume that the current
     # location is as low as voltage will be.
-    vac_rms = rms(handyscope.get_record())
+    vac_record = handyscope.get_record()
     stage.move(-5*separation*init_direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel", wait_until_idle=True)
-    geom_rms = rms(handyscope.get_record())
-    stage.move(origin, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="abs", wait_until_idle=True)
-    crack_found = lambda v: abs(v - vac_rms) > abs(v - geom_rms)
+    geom_record = handyscope.get_record()
+    # Set up while moving back to the start.
+    moved = _move_async(stage, origin, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="abs")
+    vac_rms, geom_rms = rms_batch([vac_record, geom_record])
+    crack_found = _closer_to(geom_rms, vac_rms)
     
     # geom_coords = np.zeros((len(stage.axes), 0))
-    coordinates = np.zeros((len(stage.axes), 0))
-    rms_data = np.zeros((1, 0))
+    coordinates = _ColAppender(len(stage.axes))
+    rms_data = _ColAppender(1)
+    moved.result()
     
     #%% We do not know where on the line we have started, so assume that we are
     # not at an end. Start tracing the line in one direction and move until we
     # find an end, then trace back in the other direction until we find the 
     # other end.
-    turns_since_last_seen = 0
-    current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
     # We have just found the geometry, meaning that we are sat on top of it.
-    while turns_since_last_seen < 4:
-        # geom_coords = np.append(geom_coords, current_pos, axis=1)
-        # Step once and move towards the crack.
-        stage.move(
-            # Move √(2)*d at 45°: assume we are still on the geometry. Any
-            # further and the cardinal direction would be ±90°.
-            separation*cardinal + separation*np.dot(ccwise, cardinal),
-            length_units=length_units,
-            velocity=velocity,
-            velocity_units=velocity_units,
-            mode="rel",
-            wait_until_idle=True
-        )
-        coords, scan_data, break_state = linear_scan(
-            handyscope,
-            stage,
-            3*separation*np.dot(cwise, cardinal),
-            length_units=length_units,
-            velocity=velocity,
-            velocity_units=velocity_units,
-            move_mode="rel",
-            break_fn=crack_found
-        )
-        coordinates = np.append(coordinates, coords, axis=1)
-        rms_data = np.append(rms_data, scan_data, axis=1)
-        current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
-        # Are we still on the sample? Scan will not have broken if so.
-        if not break_state:
-            # Assume we are at a corner. Rotate cardinal direction +90°, and
-            # restart the loop.
-            cardinal = np.dot(cwise, cardinal)
-            turns_since_last_seen + 1
-        else:
-            turns_since_last_seen = 0
+    _walk_edge(handyscope, stage, diag_prev, scan_next, card_idx, crack_found, coordinates, rms_data, length_units, velocity, velocity_units)
     
     #%% We must have made a full 360 since the crack was last seen - must be at
     # one end. Start going in the other direction.
-    turns_since_last_seen = 0
     stage.move(origin, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="abs", wait_until_idle=True)
-    cardinal = np.dot(ccwise, init_direction)
-    while turns_since_last_seen < 4:
-        # geom_coords = np.append(geom_coords, current_pos, axis=1)
-        # Step once and move towards the crack.
-        stage.move(
-            # Move √(2)*d at 45°: assume we are still on the geometry. Any
-            # further and the cardinal direction would be ±90°.
-            separation*cardinal + separation*np.dot(ccwise, cardinal),
-            length_units=length_units,
-            velocity=velocity,
-            velocity_units=velocity_units,
-            mode="rel",
-            wait_until_idle=True
-        )
-        coords, scan_data, break_state = linear_scan(
-            handyscope,
-            stage,
-            3*separation*np.dot(cwise, cardinal),
-            length_units=length_units,
-            velocity=velocity,
-            velocity_units=velocity_units,
-            move_mode="rel",
-            break_fn=crack_found
-        )
-        coordinates = np.append(coordinates, coords, axis=1)
-        rms_data = np.append(rms_data, scan_data, axis=1)
-        current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
-        # Are we still on the sample? Scan will not have broken if so.
-        if not break_state:
-            # Assume we are at a corner. Rotate cardinal direction +90°, and
-            # restart the loop.
-            cardinal = np.dot(cwise, cardinal)
-            turns_since_last_seen + 1
-        else:
-            turns_since_last_seen = 0
-        
-    return coordinates, rms_data#, geom_coords
+    # Start from the cardinal direction rotated -90° from init_direction.
+    _walk_edge(handyscope, stage, diag_prev, scan_next, 3, crack_found, coordinates, rms_data, length_units, velocity, velocity_units)
+    
+    return coordinates.finalize(), rms_data.finalize()#, geom_coords
 
 def trace_perimeter(
         handyscope: Handyscope,
@@ -427,39 +771,30 @@ def trace_perimeter(
         this is assumed to be where we make the transition from vac to geom.
     """
     #%% Initialise start direction. Make it a unit vector of size == len(stage.axes)
-    init_direction = np.squeeze(init_direction).reshape((-1, 1))
-    if init_direction.shape[0] > len(stage.axes):
-        raise ValueError("scan.trace_geometry: init_direction should be a vector of coodinates with length <= the number of axes.")
-    if len(stage.axes) < 2:
-        raise ValueError("scan.trace_geometry: geometry tracing requires at least two axes.")
-    if init_direction.shape[0] != len(stage.axes):
-        init_direction = np.append(init_direction, np.zeros((len(stage.axes)-init_direction.shape[0], 1)), axis=0)
-    init_direction /= np.linalg.norm(init_direction)
+    init_direction, directions = _prep_cardinal(init_direction, len(stage.axes), "scan.trace_geometry")
+    diag_prev, diag_next, scan_next, scan_prev = _move_tables(directions, separation)
     # Record the start position. Used to check whether we have completed tracing and terminate the loop.
     origin = stage.get_position(length_units)
-    # Define rotation matrices for changing cardinal directions later.
-    cwise = np.identity(len(stage.axes))
-    ccwise = np.identity(len(stage.axes))
-    cwise[:2, :2] = [[0, -1], [1, 0]]
-    ccwise[:2, :2] = [[0, 1], [-1, 0]]
     # Define initial cardinal direction.
-    cardinal = np.dot(cwise, init_direction)
+    card_idx = 1
     
     # Define break functions for moving on the geometry and off the geometry.
     # Use geometry RMS and vacuum RMS to do this: we define the edge as being
     # "found" when we are closer to one voltage than the other.
     stage.move(5*separation*init_direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel", wait_until_idle=True)
-    geom_rms = rms(handyscope.get_record())
+    geom_record = handyscope.get_record()
     stage.move(-10*separation*init_direction, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="rel", wait_until_idle=True)
-    vac_rms = rms(handyscope.get_record())
-    on_geometry  = lambda v: abs(v - geom_rms) < abs(v - vac_rms)
-    off_geometry = lambda v: abs(v - geom_rms) > abs(v - vac_rms)
-    # Reset initial position.
-    stage.move(origin, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="abs", wait_until_idle=True)
+    vac_record = handyscope.get_record()
+    # Reset initial position, setting up while the stage moves.
+    moved = _move_async(stage, origin, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode="abs")
+    geom_rms, vac_rms = rms_batch([geom_record, vac_record])
+    on_geometry  = _closer_to(geom_rms, vac_rms)
+    off_geometry = _closer_to(vac_rms, geom_rms)
     
     # geom_coords = np.zeros((len(stage.axes), 0))
-    coordinates = np.zeros((len(stage.axes), 0))
-    rms_data = np.zeros((1, 0))
+    coordinates = _ColAppender(len(stage.axes))
+    rms_data = _ColAppender(1)
+    moved.result()
     
     #%% For the first few loops, we will still be within the radius, but we do
     # not want to break out of the loop. We will still be within the first few
@@ -467,15 +802,20 @@ def trace_perimeter(
     # we leave the radius, and make this a break condition. Thus we will
     # terminate the loop when we return to the origin position.
     first = True
-    current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
+    # Positions are written into the same buffer every time rather than
+    # allocating a new array per step.
+    current_pos = np.empty((len(stage.axes), 1))
+    current_pos[:, 0] = stage.get_position(length_units)
+    # Radii for returning to and leaving the origin, squared for comparison.
+    return_radius_sq, leave_radius_sq = (1.5*separation)**2, separation**2
     # We have just found the geometry, meaning that we are sat on top of it.
-    while first or not within_radius(origin, current_pos, 1.5*separation):
+    while first or not within_radius_sq(origin, current_pos, return_radius_sq):
         # geom_coords = np.append(geom_coords, current_pos, axis=1)
         # Step once and move off the geometry.
         stage.move(
             # Move √(2)*d at 45°: assume we are still on the geometry. Any
             # further and the cardinal direction would be ±90°.
-            separation*cardinal + separation*np.dot(ccwise, cardinal),
+            diag_prev[card_idx],
             length_units=length_units,
             velocity=velocity,
             velocity_units=velocity_units,
@@ -485,21 +825,21 @@ def trace_perimeter(
         coords, scan_data, break_state = linear_scan(
             handyscope,
             stage,
-            3*separation*np.dot(cwise, cardinal),
+            scan_next[card_idx],
             length_units=length_units,
             velocity=velocity,
             velocity_units=velocity_units,
             move_mode="rel",
             break_fn=off_geometry
         )
-        coordinates = np.append(coordinates, coords, axis=1)
-        rms_data = np.append(rms_data, scan_data, axis=1)
-        current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
+        coordinates.extend(coords)
+        rms_data.extend(scan_data)
+        current_pos[:, 0] = stage.get_position(length_units)
         # Are we still on the sample? Scan will not have broken if so.
         if not break_state:
             # Assume we are at a corner. Rotate cardinal direction +90°, and
             # restart the loop.
-            cardinal = np.dot(cwise, cardinal)
+            card_idx = (card_idx+1) % 4
             continue
         
         # Store subset of scan data for which slope is largest - corresponds to
@@ -511,7 +851,7 @@ def trace_perimeter(
             # geom_coords = np.append(geom_coords, current_pos, axis=1)
             # Step once and move on the geometry.
             stage.move(
-                separation*cardinal + separation*np.dot(cwise, cardinal),
+                diag_next[card_idx],
                 length_units=length_units,
                 velocity=velocity,
                 velocity_units=velocity_units,
@@ -521,21 +861,21 @@ def trace_perimeter(
             coords, scan_data, break_state = linear_scan(
                 handyscope,
                 stage,
-                3*separation*np.dot(ccwise, cardinal),
+                scan_prev[card_idx],
                 length_units=length_units,
                 velocity=velocity,
                 velocity_units=velocity_units,
                 move_mode="rel",
                 break_fn=on_geometry
             )
-            coordinates = np.append(coordinates, coords, axis=1)
-            rms_data = np.append(rms_data, scan_data, axis=1)
-            current_pos = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
+            coordinates.extend(coords)
+            rms_data.extend(scan_data)
+            current_pos[:, 0] = stage.get_position(length_units)
             # Are we still off the sample?
             if not break_state:
                 # Assume we are at a corner. Rotate cardinal direction -90°, and
                 # restart from off the sample.
-                cardinal = np.dot(ccwise, cardinal)
+                card_idx = (card_idx-1) % 4
         
         # Store subset of scan data for which slope is largest - corresponds to
         # change from vacuum to geometry.
@@ -543,10 +883,10 @@ def trace_perimeter(
         
         # See whether we have left the radius. Only do this in the first few
         # iterations: after we have left this radius, no need to keep checking.
-        if first and not within_radius(origin, current_pos, separation):
+        if first and not within_radius_sq(origin, current_pos, leave_radius_sq):
             first = False
         
-    return coordinates, rms_data#, geom_coords
+    return coordinates.finalize(), rms_data.finalize()#, geom_coords
             
     
 #%%
@@ -605,27 +945,21 @@ def grid_sweep_scan(handyscope, stage, origin, width, height, rotation, separati
     
     # Initialise position. Will be absolute and we need it to wait until it arrives.
     stage.move(coords[0, :], length_units=length_units, velocity=velocity, velocity_units=velocity_units)
-    # Start the scan.
-    rms_data = None
-    for idx, step in enumerate(coords):
+    # Start the scan. Rows of the scan data are x, y and RMS voltage.
+    scan_data = _ColAppender(3)
+    for step in coords:
         # Do the scan
-        if live_plot:
-            x_scan, y_scan, rms_scan = linear_scan_rms(handyscope, stage, step, length_units=length_units, velocity=velocity, velocity_units=velocity_units, live_plot=live_plot, old_val=rms_data)
-        else:
-            x_scan, y_scan, rms_scan = linear_scan_rms(handyscope, stage, step, length_units=length_units, velocity=velocity, velocity_units=velocity_units)
+        x_scan, y_scan, rms_scan = linear_scan_rms(handyscope, stage, step, length_units=length_units, velocity=velocity, velocity_units=velocity_units, live_plot=live_plot, old_val=scan_data.view()[2] if scan_data.n > 0 else None)
         
         # Save the data.
-        if idx == 0:
-            #Initialise output arrays
-            x_data = x_scan
-            y_data = y_scan
-            rms_data = rms_scan
-        else:
-            # Append data
-            x_data   = np.append(x_data, x_scan)
-            y_data   = np.append(y_data, y_scan)
-            rms_data = np.append(rms_data, np.asarray(rms_scan), axis=0)
+        scan_data.extend(np.vstack((x_scan, y_scan, rms_scan)))
     
+    # Every line of the sweep has drawn into the same live plot. Close it now
+    # that the sweep is finished.
+    if live_plot:
+        _LivePlot.close_shared()
+    
+    x_data, y_data, rms_data = scan_data.finalize()
     return x_data, y_data, rms_data
 
 #%%
@@ -640,7 +974,10 @@ def linear_scan(
         scan_mode: str = "RMS",
         break_fn: Callable[[float], bool] = None,
         live_plot: bool = False,
-        old_val: np.ndarray[float] = None
+        old_val: np.ndarray[float] = None,
+        freq_range: Tuple[float, float] = None,
+        sample_period: float = None,
+        resolution: float = None
     ) -> Tuple[np.ndarray[float], np.ndarray[Union[float, complex]], bool]:
     """
     Scans the sample using the handyscope while the stage moves the substrate
@@ -685,6 +1022,24 @@ def linear_scan(
     old_val : np.ndarray[float], optional
         Used when live_plot is True, new values are appended to the end of this
         array. The default is None, meaning that no values appended.
+    freq_range : (float, float), optional
+        Used when live_plot is True and scan_mode is "spec": frequencies within
+        this range (in Hz, including both ends) are also plotted in an inset.
+        The default is None, meaning that only the whole spectrum is plotted.
+    sample_period : float, optional
+        Time in seconds from the start of one sample to the start of the next,
+        when live_plot is False. Only the time remaining after acquiring and
+        processing each sample is slept, so samples are taken at a steady rate.
+        Set to 0 to sample as fast as the handyscope allows. The default is
+        None, meaning that it is worked out from resolution. Cannot be given
+        together with resolution.
+    resolution : float, optional
+        Distance (in length_units) the stage should move between samples when
+        live_plot is False, from which the sample period is worked out as
+        resolution / velocity. Faster scans are then sampled more often, so
+        the spacing of the samples stays the same. The default is None: with
+        no spacing to work from, the sample period is .01, which was the fixed
+        rate used before either option was available.
 
     Returns
     -------
@@ -692,7 +1047,9 @@ def linear_scan(
         Coordinates of the stage when the mth scan was taken. Positions of all
         N axes are recorded.
     scan_data : np.ndarray[float] (L, M)
-        Data acquired by the handyscope by the lth channel during the scan.
+        Data acquired by the handyscope by the lth channel during the scan. In
+        "spec" mode, this is the single precision complex spectrum of each
+        record, with L frequencies.
     break_state : bool
         Whether the stage terminated by reaching the target, or whether the
         break_fn returned True and the scan terminated early.
@@ -707,60 +1064,117 @@ def linear_scan(
         raise ValueError("scan.linear_scan: scan mode must be one of {}".format(valid_scans))
     if old_val is not None:
         old_val = np.squeeze(old_val)
+    if sample_period is not None and resolution is not None:
+        raise ValueError("scan.linear_scan: only one of sample_period and resolution can be given.")
+    if resolution is not None:
+        # Work out the velocity in the length units per second, as Stage.move
+        # does, so that it can be compared with resolution.
+        if velocity_units != l2v_units(length_units):
+            native_value = stage.axes[0].settings.convert_to_native_units("vel", velocity, velocity_units)
+            sample_period = resolution / stage.axes[0].settings.convert_from_native_units("vel", native_value, l2v_units(length_units))
+        else:
+            sample_period = resolution / velocity
+    elif sample_period is None:
+        sample_period = .01
         
-    # Initialise output arrays
-    coordinates = np.zeros((len(stage.axes), 0))
+    # Initialise output arrays. These grow as the data is acquired, without
+    # copying everything collected so far each time.
+    coordinates = _ColAppender(len(stage.axes), capacity=256, dtype=float)
     if scan_mode == "rms":
-        scan_data = np.zeros((0))
+        scan_data = _ColAppender(1, capacity=256, dtype=float)
     elif scan_mode == "spec":
-        freq = np.fft.rfftfreq(handyscope.scp.record_length, 1/handyscope.scp.sample_frequency)
-        scan_data = np.zeros((freq.shape[0], 0))
+        freq = fft.rfftfreq(handyscope.scp.record_length, 1/handyscope.scp.sample_frequency)
+        # Records are single precision, so their spectra are too.
+        scan_data = _ColAppender(freq.shape[0], capacity=256, dtype=np.complex64)
+        # Unless they are plotted as they arrive, the records are transformed
+        # all at once at the end of the scan.
+        records = []
     # Return state for break
     break_state = False
     
+    # Bind the methods called on every sample to locals, so that they are not
+    # looked up again each time around the loop.
+    axes = stage.axes
+    get_position = stage.get_position
+    if scan_mode == "spec" and not live_plot:
+        get_record = handyscope.get_record
+    else:
+        # Each record is processed before the next is taken, so they can all
+        # be written into the same array.
+        record = handyscope.empty_record()
+        def get_record():
+            return handyscope.get_record_into(record)
+    
     # Start moving the stage
     stage.move(target, length_units=length_units, velocity=velocity, velocity_units=velocity_units, mode=move_mode, wait_until_idle=False)
     
+    # Specialise processing and plotting to the scan mode up front, so that the
+    # loop does not have to check it for every sample. Processing returns the
+    # RMS of the record when it is computed anyway, else None.
+    if scan_mode == "rms":
+        def process(scan_val):
+            scan_rms = rms(scan_val)
+            scan_data.append(scan_rms)
+            return scan_rms
+    elif live_plot:
+        def process(scan_val):
+            scan_data.append(fft.rfft(scan_val[0, :]))
+    else:
+        def process(scan_val):
+            records.append(scan_val[0, :])
+    
+    if live_plot:
+        if scan_mode == "rms":
+            plot = _LivePlot.shared()
+            def show(force=False):
+                plot.update(np.append(old_val[-100+scan_data.n:], scan_data.view()[0]) if old_val is not None else scan_data.view()[0], force=force)
+        elif scan_mode == "spec":
+            # The frequencies are fixed, so the spectrum is blitted onto axes
+            # which are only drawn in full when it outgrows them.
+            plot = _SpectrumPlot.shared(freq, _freq_bins(freq, freq_range))
+            def show(force=False):
+                plot.update(scan_data.view()[:, -1])
+    
     #%% Start collecting the data
-    while any([stage.axes[i].is_busy() for i in range(len(stage.axes))]):
-        step_loc = np.asarray(stage.get_position(length_units)).reshape(-1, 1)
-        scan_val = handyscope.get_record()
+    # Each is_busy() is a round-trip to the controller, so stop polling at the
+    # first axis which is still moving.
+    while any(axis.is_busy() for axis in axes):
+        sample_start = time.perf_counter()
+        # Query the stage while the handyscope is recording, rather than
+        # waiting for one and then the other.
+        step_loc = _stage_pool().submit(get_position, length_units)
+        scan_val = get_record()
+        step_loc = step_loc.result()
         
         # Process the data and store it
-        coordinates = np.append(coordinates, step_loc, axis=1)
-        if scan_mode == "rms":
-            scan_data = np.append(scan_data, rms(scan_val))
-        elif scan_mode == "spec":
-            scan_data = np.append(scan_data, np.fft.rfft(scan_val[0, :]), axis=1)
+        coordinates.append(step_loc)
+        scan_rms = process(scan_val)
         
         # Live plot it
         if live_plot:
-            fig = plt.figure(figsize=(12,5),dpi=100)
-            ax1 = fig.add_subplot(111)
-            if scan_mode == "rms":
-                if old_val is not None:
-                    plt.plot(np.append(old_val[-100+len(scan_data):], scan_data))
-                else:
-                    plt.plot(scan_data)
-            elif scan_mode == "spec":
-                ax1.plot(freq*1e-6, np.abs(scan_data[-1]))
-            plt.show(block=False)
+            show()
         
         # Check whether to break
         if break_fn is not None:
-            if break_fn(rms(scan_val)):
+            if break_fn(rms(scan_val) if scan_rms is None else scan_rms):
                 stage.stop()
                 break_state = True
                 break
         
-        # Sleep and try again in .1 seconds
+        # Wait for the rest of the sample period before trying again.
         if not live_plot:
-            time.sleep(.01)
+            remaining = sample_period - (time.perf_counter() - sample_start)
+            if remaining > 0:
+                time.sleep(remaining)
     
-    if scan_mode == "rms":
-        scan_data = np.reshape(scan_data, (1, -1))
+    if scan_mode == "spec" and records:
+        scan_data.extend(fft.rfft(np.stack(records), axis=1).T)
+    
+    # Make sure the final samples are shown.
+    if live_plot and scan_data.n > 0:
+        show(force=True)
     
-    return coordinates, scan_data, break_state
+    return coordinates.finalize(), scan_data.finalize(), break_state
 
 #%%
 def linear_scan_rms(handyscope, stage, target, length_units=Units.LENGTH_MILLIMETRES, velocity=1, velocity_units=Units.VELOCITY_MILLIMETRES_PER_SECOND, move_mode="abs", live_plot=False, old_val=None):
@@ -768,33 +1182,36 @@ def linear_scan_rms(handyscope, stage, target, length_units=Units.LENGTH_MILLIME
     Collect RMS data from handyscope while stage moves the substrate in a line.
     """
     warnings.warn("linear_scan_rms will soon be deprecated, please replace with linear_scan()")
-    # Initialise storage
-    x   = []
-    y   = []
-    v = []
+    # Initialise storage. Rows are x, y and RMS voltage.
+    samples = _ColAppender(3, capacity=256, dtype=float)
     # Start moving the stage
     stage.move(target, length_units=Units.LENGTH_MILLIMETRES, velocity=velocity, velocity_units=Units.VELOCITY_MILLIMETRES_PER_SECOND, mode=move_mode, wait_until_idle=False)
+    if live_plot:
+        plot = _LivePlot.shared()
 
     # Collect the data
-    while abs(target[0] - stage.axis2.get_position(Units.LENGTH_MILLIMETRES)) > stage.mm_resolution or abs(target[1] - stage.axis1.get_position(Units.LENGTH_MILLIMETRES)) > stage.mm_resolution:
-        v.append(rms(handyscope.get_record()))
-        x.append(stage.axis2.get_position(Units.LENGTH_MILLIMETRES))
-        y.append(stage.axis1.get_position(Units.LENGTH_MILLIMETRES))
+    while True:
+        # Query each axis once per sample, and use the same position both to
+        # check whether we have arrived and to record where the sample is.
+        x_pos = stage.axis2.get_position(Units.LENGTH_MILLIMETRES)
+        y_pos = stage.axis1.get_position(Units.LENGTH_MILLIMETRES)
+        if abs(target[0] - x_pos) <= stage.mm_resolution and abs(target[1] - y_pos) <= stage.mm_resolution:
+            break
+        samples.append((x_pos, y_pos, rms(handyscope.get_record())))
         # Only collect 100 times per second - #TODO will need tweaking depending on velocity.
         # Plotting takes a bit of time, else explicitly sleep for a period of time.
         if live_plot:
-            if len(v) < 100:
-                if old_val is not None:
-                    plt.plot(list(old_val[-100+len(v):]) + v)
-                else:
-                    plt.plot(v)
-            else:
-                plt.plot(v[-100:])
-            plt.show()
+            # Show the last 100 values, topped up from old_val if there are
+            # not enough yet.
+            recent = samples.view()[2, -100:]
+            if recent.size < 100 and old_val is not None:
+                recent = np.concatenate((old_val[-100+recent.size:], recent))
+            plot.update(recent)
         else:
             time.sleep(.01)
         
-    return np.asarray(x), np.asarray(y), np.asarray(v)
+    x, y, v = samples.finalize()
+    return x, y, v
 
 def linear_scan_spec(handyscope, stage, target, length_units=Units.LENGTH_MILLIMETRES, velocity=1, velocity_units=Units.VELOCITY_MILLIMETRES_PER_SECOND, move_mode="abs", live_plot=False, freq_range=None):
     """
@@ -806,29 +1223,35 @@ def linear_scan_spec(handyscope, stage, target, length_units=Units.LENGTH_MILLIM
     x    = []
     y    = []
     spec = []
-    freq = np.fft.rfftfreq(handyscope.scp.record_length, 1/handyscope.scp.sample_frequency)
+    freq = fft.rfftfreq(handyscope.scp.record_length, 1/handyscope.scp.sample_frequency)
     # Start moving the stage
     stage.move(target, length_units=Units.LENGTH_MILLIMETRES, velocity=velocity, velocity_units=Units.VELOCITY_MILLIMETRES_PER_SECOND, mode=move_mode, wait_until_idle=False)
     
-    if live_plot and freq_range is not None:
-        f1 = np.argmin(np.abs(freq - freq_range[0]))
-        f2 = np.argmin(np.abs(freq - freq_range[1]))
-    # Collect the data
-    while abs(target[0] - stage.axis2.get_position(Units.LENGTH_MILLIMETRES)) > stage.mm_resolution or abs(target[1] - stage.axis1.get_position(Units.LENGTH_MILLIMETRES)) > stage.mm_resolution:
-        spec.append(np.fft.rfft(handyscope.get_record()[0, :]))
-        x.append(stage.axis2.get_position(Units.LENGTH_MILLIMETRES))
-        y.append(stage.axis1.get_position(Units.LENGTH_MILLIMETRES))
+    if live_plot:
+        plot = _SpectrumPlot.shared(freq, _freq_bins(freq, freq_range))
+    # Collect the data. Unless they are plotted as they arrive, the records are
+    # transformed all at once at the end of the scan.
+    records = []
+    while True:
+        # Query each axis once per sample, and use the same position both to
+        # check whether we have arrived and to record where the sample is.
+        x_pos = stage.axis2.get_position(Units.LENGTH_MILLIMETRES)
+        y_pos = stage.axis1.get_position(Units.LENGTH_MILLIMETRES)
+        if abs(target[0] - x_pos) <= stage.mm_resolution and abs(target[1] - y_pos) <= stage.mm_resolution:
+            break
+        if live_plot:
+            spec.append(fft.rfft(handyscope.get_record()[0, :]))
+        else:
+            records.append(handyscope.get_record()[0, :])
+        x.append(x_pos)
+        y.append(y_pos)
         # Only collect 100 times per second - #TODO will need tweaking depending on velocity.
         # Plotting takes a bit of time, else explicitly sleep for a period of time.
         if live_plot:
-            fig = plt.figure(figsize=(12,5),dpi=100)
-            ax1 = fig.add_subplot(111)
-            ax1.plot(freq*1e-6, np.abs(spec[-1]))
-            if freq_range is not None:
-                ax2 = fig.add_axes([.35, .25, .525, .6])
-                ax2.plot(freq[f1:f2]*1e-6, np.abs(spec[-1][f1:f2]))
-            plt.show(block=False)
+            plot.update(spec[-1])
         else:
             time.sleep(.01)
     
+    if records:
+        spec = list(fft.rfft(np.stack(records), axis=1))
     return x, y, spec
\ No newline at end of file
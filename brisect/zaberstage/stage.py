@@ -162,7 +162,7 @@ class Stage:
         # before this method has terminated. We want to avoid this.
         if wait_until_idle:
             # While any axes are still busy
-            while any([self.axes[i].is_busy() for i in range(len(self.axes))]):
+            while any(axis.is_busy() for axis in self.axes):
                 # Sleep and try again in .1 seconds
                 time.sleep(.1)
     
@@ -207,9 +207,12 @@ class Stage:
         
         vel_units = l2v_units(length_units)
         
+        # Split into (x, y) waypoints once, rather than for each move.
+        waypoints = np.column_stack((circle_r.real, circle_r.imag))
+        
         self.move(centre + np.squeeze([radius, 0]), length_units=length_units)
-        for i in range(N):
-            self.move([np.real(circle_r[i]), np.imag(circle_r[i])], length_units=length_units, velocity=v0, velocity_units=vel_units)
+        for waypoint in waypoints:
+            self.move(waypoint, length_units=length_units, velocity=v0, velocity_units=vel_units)
 
 
 
@@ -19,7 +19,13 @@ freq_2 = 55e3
 with Handyscope.from_yaml("chirp_ex.yml") as scope:
     # Work out the input signal
     timepts = np.linspace(0, (scope.scp.record_length-1)/scope.gen.frequency, scope.scp.record_length)
-    signal = np.sin(2*np.pi*timepts * (freq_1 + timepts * (freq_2 - freq_1)/(2*timepts[-1])))
+    # Build the phase in place, so only one array the length of the record is
+    # allocated.
+    signal = timepts * ((freq_2 - freq_1)/(2*timepts[-1]))
+    signal += freq_1
+    signal *= timepts
+    signal *= 2*np.pi
+    np.sin(signal, out=signal)
     scope.set_data(signal)
     
     # Do the data collection.
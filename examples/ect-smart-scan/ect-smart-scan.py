@@ -12,6 +12,8 @@ N.B. in device_list, device 0 is the z-axis, device 1 is the y-axis and device
 2 is the x-axis.
 """
 import brisect as ect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from brisect.handyscope import Handyscope
 from brisect.zaberstage import Stage
 import matplotlib.pyplot as plt
@@ -38,38 +40,48 @@ if __name__ == "__main__":
         
     settings = ect.read_settings(yaml_filename)
     
+    # Connecting to each device is slow, so connect to both at the same time.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        stage_future = pool.submit(Stage)
+        handyscope_future = pool.submit(Handyscope.from_yaml, yaml_filename)
+    
     #%% Start the scan
-    with Stage() as stage:
-        with Handyscope.from_yaml(yaml_filename) as handyscope:
-            print(handyscope)
-            
-            # Look for the geometry and trace it out.
-            coordinates, rms_data, geometry = ect.domain_search(
-                handyscope, 
-                stage,
-                origin=[50, 80, 11.8],
-                # origin=[settings['trajectory']['init_x'], settings['trajectory']['init_y'], settings['trajectory']['init_z']],
-                width=110,
-                height=110,
-                snake_separation=25,
-                velocity=7.5,
-                fuzzy_separation=5,
-                # live_plot=True
-            )
-            
-            # We have an approximation for the geometry. Scan within it to look for defects.
-            coords, rms_scan, defect_coords = ect.domain_search(
-                handyscope,
-                stage,
-                origin=[geometry['rect'][1][0]+10, geometry['rect'][1][1]+10, 11.8], #TODO: check that this unpacks correctly.
-                width=geometry['rect'][1][2]-20,
-                height=geometry['rect'][1][3]-20,
-                snake_separation=5,
-                fuzzy_separation=1
-            )
-            coordinates = np.append(coordinates, coords, axis=1)
-            rms_data = np.append(rms_data, rms_scan, axis=1)
-            
-            # Save the data.
-            ect.plot_data(settings["job"]["name"], coords, rms_scan)
-            ect.save_csv(settings["job"]["name"], np.squeeze(coordinates[0, :]), np.squeeze(coordinates[1, :]), np.squeeze(rms_data))
+    with ExitStack() as devices:
+        # Enter every device which connected, so that they are all closed
+        # again if the other one failed.
+        for future in (stage_future, handyscope_future):
+            if future.exception() is None:
+                devices.enter_context(future.result())
+        stage, handyscope = stage_future.result(), handyscope_future.result()
+        print(handyscope)
+        
+        # Look for the geometry and trace it out.
+        coordinates, rms_data, geometry = ect.domain_search(
+            handyscope, 
+            stage,
+            origin=[50, 80, 11.8],
+            # origin=[settings['trajectory']['init_x'], settings['trajectory']['init_y'], settings['trajectory']['init_z']],
+            width=110,
+            height=110,
+            snake_separation=25,
+            velocity=7.5,
+            fuzzy_separation=5,
+            # live_plot=True
+        )
+        
+        # We have an approximation for the geometry. Scan within it to look for defects.
+        coords, rms_scan, defect_coords = ect.domain_search(
+            handyscope,
+            stage,
+            origin=[geometry['rect'][1][0]+10, geometry['rect'][1][1]+10, 11.8], #TODO: check that this unpacks correctly.
+            width=geometry['rect'][1][2]-20,
+            height=geometry['rect'][1][3]-20,
+            snake_separation=5,
+            fuzzy_separation=1
+        )
+        coordinates = np.concatenate((coordinates, coords), axis=1)
+        rms_data = np.concatenate((rms_data, rms_scan), axis=1)
+        
+        # Save the data.
+        ect.plot_data(settings["job"]["name"], coords, rms_scan)
+        ect.save_csv(settings["job"]["name"], coordinates[0], coordinates[1], rms_data.ravel())